@@ -2,18 +2,40 @@
 
 """
 A tool for reading files that sue the Fortran "unformatted" format.
-The class FortranIO.FortranIO is a subclass of file with additional methods to read such files into numpy arrays.
-See its docstring for more info.
+The class FortranIO.FortranIO is a file object with additional methods to read such files into numpy arrays.
+The class FortranIO.FortranRecord reads hyperslabs of a single record without reading the whole of it.
+The class FortranIO.FortranMap gives random access to the records of such a file through a memory map.
+The function FortranIO.readEnsemble reads the same record from many files at once on a thread pool.
+The function FortranIO.transcode streams a file of like records into chunked netCDF4 or a directory of .npy chunks.
+The class FortranIO.AsyncFortranReader prefetches records in the background for use with asyncio.
+The class FortranIO.FortranDirect reads Fortran "direct" access (and GrADS-style) files of fixed-length records
+that have no sentinels.
+See their docstrings for more info.
 
 The "unformat" is a series of records that look like:
 [number of bytes in following data] [data] [number of bytes in preceding data]
 where the numbers of bytes are usually recorded as unsigned 32bit integers.  This is not standardized, though, so you can select this if your fortran compiler does something different.  In particular, earlier versions of gfortran
 
+With 32bit sentinels, gfortran splits records longer than 2**31-9 bytes into subrecords, each with its own pair of sentinels.
+A negative leading sentinel means that more subrecords follow, and a negative trailing sentinel that others precede.
+Such records are read and written transparently.
+
 Like all Fortran-later language interoperability code documentation should, this docstring ends with an exhortation to please stop using fortran.
 """
 
+import asyncio
+import io
+import itertools
+import json
+import mmap
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import os
 import struct
+import tempfile
+import threading
+import weakref
+import zipfile
 
 
 class SentinelError(IOError):
@@ -22,26 +44,168 @@ class SentinelError(IOError):
     """
     pass
 
-class FortranIO(file):
+def _byteorder(endian):
+    """
+    Internal function to translate an endianness flag into a numpy byte-order character.
+    Parameters
+    ----------
+    endian : '=', '!', '>' or '<', as for FortranIO
+
+    Returns
+    -------
+    c : '>' or '<'
+
+    Raises
+    ------
+    ValueError : If an endianness other than '=','!','>','<' is specified
+    """
+    try:
+        return {
+        "=": "<" if np.little_endian else ">",
+        "!": ">" if np.little_endian else "<",
+        ">": ">",
+        "<": "<",
+        }[endian]
+    except KeyError:
+        raise ValueError("Endianness must be in [=,<,>,!], not %s" % endian)
+
+def _sentinelStruct(endian,sentinel):
+    """
+    Internal function returning a struct.Struct that unpacks a sentinel of type sentinel
+    written with byte order endian.
+    """
+    dt=np.dtype(sentinel)
+    try:
+        code={
+        ("u",4): "I",
+        ("u",8): "Q",
+        ("i",4): "i",
+        ("i",8): "q",
+        }[(dt.kind,dt.itemsize)]
+    except KeyError:
+        raise ValueError("Sentinel must be a 32 or 64-bit integer type, not %s" % dt)
+    return struct.Struct(_byteorder(endian)+code)
+
+# gfortran splits records longer than this into subrecords when the sentinel is 32-bit
+_SUBRECORD=2**31-9
+# writes of fewer bytes than this go through the file buffer; larger ones are gathered with os.writev
+_GATHER=2**16
+# most buffers passed to a single os.writev
+_IOV_MAX=1024
+
+def _marker(l,size):
+    """
+    Internal function to decode a sentinel l of size bytes as a gfortran subrecord marker.
+    Parameters
+    ----------
+    l : int, the sentinel as read
+    size : int, the size of the sentinel in bytes
+
+    Returns
+    -------
+    nb : int, the number of bytes in the (sub)record
+    continued : bool, True if the marker is negative (read as unsigned, if it is 2**31 or more).
+                Only 32-bit sentinels can be negative.
     """
-    A subclass of the buitin file type, with additional methods to read and write numpy
+    if size==4 and (l<0 or l>=2**31):
+        return (-l if l<0 else 2**32-l),True
+    return l,False
+
+def _probe(fh,size,sentinel,nrec=2):
+    """
+    Internal function to check that the first nrec records of a file fit sentinels unpacked by the
+    struct.Struct sentinel: each leading sentinel must be matched by the trailing one,
+    and every record must lie within the size of the file.
+    """
+    ssize=sentinel.size
+    pos=0
+    for i in range(nrec):
+        more=pos<size
+        while more:
+            if pos+ssize>size:
+                return False
+            fh.seek(pos)
+            nb,more=_marker(sentinel.unpack(fh.read(ssize))[0],ssize)
+            end=pos+ssize+nb
+            if end+ssize>size:
+                return False
+            fh.seek(end)
+            if _marker(sentinel.unpack(fh.read(ssize))[0],ssize)[0]!=nb:
+                return False
+            pos=end+ssize
+    return True
+
+def _detect(fh,endian="auto",sentinel="auto"):
+    """
+    Internal function to detect the endianness and/or the sentinel type of a Fortran unformatted file
+    by probing its first records with each candidate in turn (32-bit before 64-bit sentinels,
+    native before non-native byte order).
+    Parameters
+    ----------
+    fh : readable and seekable binary file object; its position is left unchanged
+    endian : 'auto' to detect, or an endianness as for FortranIO
+    sentinel : 'auto' to detect, or a sentinel type as for FortranIO
+
+    Returns
+    -------
+    endian : '>' or '<' if detected (the default if the file is empty), otherwise as given
+    sentinel : np.uint32 or np.uint64 if detected (the default if the file is empty), otherwise as given
+
+    Raises
+    ------
+    SentinelError : If no candidate fits the file.
+    """
+    endians=[_byteorder("="),_byteorder("!")] if endian=="auto" else [endian]
+    sentinels=[np.uint32,np.uint64] if sentinel=="auto" else [sentinel]
+    pos=fh.tell()
+    try:
+        size=fh.seek(0,io.SEEK_END)
+        for st in sentinels:
+            for e in endians:
+                if _probe(fh,size,_sentinelStruct(e,st)):
+                    return e,st
+    finally:
+        fh.seek(pos)
+    raise SentinelError("Unable to detect the endianness and sentinel of the Fortran file")
+
+class FortranIO(object):
+    """
+    A file object with additional methods to read and write numpy
     arrays from/to files in the Fortran "unformatted" format.
 
     The format does not seem to be standardized, but always seems to consist of a sentinel indicating the
-    size in bytes of the following field, then the data, then the data, and then the same sentinel.
+    size in bytes of the following field, then the data, and then the same sentinel.
 
     For newer versions of gfortran (4.2 and later) and intel fortran, the sentinel is a 32-bit integer.
 
+    Data are read with readinto straight into numpy arrays, and byte order is handled through the data type
+    of the returned array rather than by swapping a copy.  A caller-supplied buffer can be filled in place:
+
+        f = FortranIO('fcst.bin', endian='>')
+        buf = np.empty((ny, nx), dtype=np.float32)
+        for t in range(nt):
+            f.readArray(np.float32, out=buf)    # no allocation per record
+
     If a read of an array fails the file is returned to where it started before the read, and an error raised.
     This is to help with exploring unknow formats.
+
+    Arrays are written without copying them: small records are combined in the file buffer, large ones and
+    batches of records (writeArrays) are gathered into os.writev calls, and arrays that need their byte order
+    swapped or are not contiguous are converted a chunk at a time through a reusable scratch buffer.
+
+    Methods of the underlying buffered file object (seek, tell, read, write, flush, ...) are available
+    directly on FortranIO.
     """
-    def __init__(self,name, mode='r', buffering=0,endian="=",sentinel=np.uint32):
+    # size of the scratch buffer for byte swapping on write
+    _scratchsize=2**20
+
+    def __init__(self,name, mode='r', buffering=-1,endian="=",sentinel=np.uint32):
         """Open the file for reading or writing.
         Parameters
         __________
         name : the filename
-        mode : the read/write mode ("r","w","rw", etc.)
-        buffering : 0 for unbuffered, 1 for line buffers, >1 for buffer size
+        mode : the read/write mode ("r","w","r+", etc.); files are always opened in binary mode
+        buffering : 0 for unbuffered, >1 for buffer size, -1 for the default buffer size (default)
 
         endian : '=' for native (default)
                  '!' for non-native
@@ -50,8 +214,12 @@ class FortranIO(file):
                  This should depend on the architecture of the system
                  where the file was written, or is to be read.  If you are not
                  transferring files between machines then you can always leave this as the default.
+                 'auto' to detect it from the first records of the file.
         sentinel : This specifies the data type of the sentinel used in the unformatted file.
                       The default is correct at least for gfortran versions >= 4.2 and ifort, and probably lots of others.
+                      'auto' to detect a 32 or 64-bit sentinel from the first records of the file.
+                   Detected settings are kept in self.endian and self.sentinel for the rest of the session.
+                   A file that is empty or not readable gets the defaults.
 
         Returns
         -------
@@ -59,22 +227,48 @@ class FortranIO(file):
 
         Raises
         ------
-        ValueError : If an endianness other than '=','!','>','<' is specified
-        IOError : If raised by the superclass constructor.
-        TypeError : If raised by the superclass constructor.
+        ValueError : If an endianness other than '=','!','>','<','auto' is specified
+        SentinelError : If the endianness or sentinel cannot be detected.
+        IOError : If raised by io.open.
+        TypeError : If raised by io.open.
         """
-        file.__init__(self, name, mode, buffering)
-        self.endian=endian
-        self.sentinel=sentinel
+        if "b" not in mode:
+            mode+="b"
+        self._file=io.open(name,mode,buffering)
         try:
-            self.swap = {
-            "=":      {True:False, False:False},  #native byte order; never swap
-            "!":      {True:True,  False:True},   #non-native byte order; always swap
-            ">":      {True:True,  False:False},  #big endian; swap if system little-endian
-            "<":      {True:False, False:True},   #little endian; swap if system big-endian
-            }[endian] [np.little_endian]
-        except KeyError:
-            raise ValueError("Endianness must be in [=,<,>,!], not %s" % endian)
+            if "auto" in (endian,sentinel):
+                if self._file.readable():
+                    endian,sentinel=_detect(self._file,endian,sentinel)
+                else:
+                    endian,sentinel=("=" if endian=="auto" else endian),(np.uint32 if sentinel=="auto" else sentinel)
+            self.endian=endian
+            self.sentinel=sentinel
+            self._byteorder=_byteorder(endian)
+            self._sentinel=_sentinelStruct(endian,sentinel)
+        except (IOError,ValueError):
+            self._file.close()
+            raise
+        self.swap=self._byteorder!=_byteorder("=")
+        # gather writes bypass the file buffer, which is only safe if it holds no data read ahead
+        self._gather=hasattr(os,"writev") and not self._file.readable()
+        self._scratch=None
+        # positions of the records found so far; see record()
+        self._offsets=[0]
+
+    def __getattr__(self,attr):
+        # delegate the file methods to the underlying file object
+        if attr=="_file":
+            raise AttributeError(attr)
+        return getattr(self._file,attr)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+    def __iter__(self):
+        return iter(self._file)
 
     def _readSentinel(self):
         """
@@ -92,12 +286,10 @@ class FortranIO(file):
         SentinelError
             if sentinel could not be read (end of file?)
         """
-        l=np.fromfile(self,self.sentinel,1)
-        if self.swap:
-            l=l.byteswap()
-        if not len(l)==1:
+        b=self._file.read(self._sentinel.size)
+        if not len(b)==self._sentinel.size:
             raise SentinelError("Fortran sentinel not found.")
-        return int(l[0])  #have to convert to int owing to what seems to be a bug in integer division of uint64s in numpy
+        return self._sentinel.unpack(b)[0]
 
     def _checkSentinel(self,x):
         """
@@ -121,6 +313,86 @@ class FortranIO(file):
         if x2!=x:
             raise SentinelError("Incorrect sentinel in Fortran File")
 
+    def _readMarker(self):
+        """
+        Internal method to read a sentinel as a subrecord marker; see _marker.
+        """
+        return _marker(self._readSentinel(),self._sentinel.size)
+
+    def _packMarker(self,nb,negative=False):
+        """
+        Internal method to pack the sentinel of a (sub)record of nb bytes, negated if negative.
+        """
+        if negative:
+            nb=2**32-nb if self._sentinel.format.endswith("I") else -nb
+        return self._sentinel.pack(nb)
+
+    def _recordSegments(self):
+        """
+        Internal method to walk the subrecords of the record at the current position, without reading the data.
+        A record that is not split is a single subrecord.
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        segments : list of (position, number of bytes) of the data of each subrecord.
+                   The file is left positioned after the record.
+
+        Raises
+        ------
+        SentinelError
+            if a sentinel is missing or incorrect
+        """
+        segments=[]
+        more=True
+        while more:
+            nb,more=self._readMarker()
+            segments.append((self.tell(),nb))
+            self.seek(nb,1) #seek from the current position
+            if self._readMarker()[0]!=nb:
+                raise SentinelError("Incorrect sentinel in Fortran File")
+        return segments
+
+    def _readSegments(self,segments,buf):
+        """
+        Internal method to fill buf with the data of the subrecords segments (see _recordSegments),
+        leaving the file positioned after the record.
+        """
+        mv=memoryview(buf).cast("B")
+        n=0
+        for pos,nb in segments:
+            self.seek(pos)
+            self._readInto(mv[n:n+nb])
+            n+=nb
+        self.seek(pos+nb+self._sentinel.size)
+
+    def _readInto(self,buf):
+        """
+        Internal method to fill a writable buffer from the file with readinto.
+        Parameters
+        ----------
+        buf : writable, C-contiguous buffer (bytearray, memoryview, ndarray)
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        IOError
+            if the file ends before the buffer is filled
+        """
+        mv=memoryview(buf).cast("B")
+        nb=len(mv)
+        n=0
+        while n<nb:
+            m=self._file.readinto(mv[n:])
+            if not m:
+                raise IOError("Fortran array format not correct")
+            n+=m
+
     def readString(self):
         """Read in a string from a Fortran file.
         Parameters
@@ -129,7 +401,7 @@ class FortranIO(file):
 
         Returns
         -------
-        s : string, read from file.
+        s : bytes, read from file.
 
         Raises
         ------
@@ -140,18 +412,20 @@ class FortranIO(file):
         pos=self.tell()
         try:
             l=self._readSentinel()
-            s = self.read(l)
+            s=self.read(l)
+            if not len(s)==l:
+                raise IOError("String not read correctly from fortran file.  Incorrect format.")
             self._checkSentinel(l)
-        except IOError as e:
+        except IOError:
             self.seek(pos)
-            raise e("String not read correctly from fortran file.  Incorrect format.")
+            raise
         return s
 
     def writeString(self,s):
         """Write a string to a fortran file.
         Parameters
         ----------
-        s : String to be written to file
+        s : String (encoded as ASCII) or bytes to be written to file
 
         Returns
         -------
@@ -162,12 +436,13 @@ class FortranIO(file):
         IOError : If unable to write to file.
 
         """
-        sentinel = np.array([len(s)],dtype=self.sentinel)
-        if self.swap:
-            sentinel=sentinel.byteswap()
-        sentinel.tofile(self)
+        if isinstance(s,str):
+            s=s.encode("ascii")
+        self._offsets=[0]
+        sentinel=self._sentinel.pack(len(s))
+        self.write(sentinel)
         self.write(s)
-        sentinel.tofile(self)
+        self.write(sentinel)
 
 
     def readArrays(self,dtypes,shapes=None):
@@ -194,15 +469,13 @@ class FortranIO(file):
             if shapes is None:
                 shapes=[None]*len(dtypes)
             return [self.readArray(dtype,shape) for dtype,shape in zip(dtypes,shapes)]
-        except IOError as e:
-            self.tell(pos)
-            raise e
-        except ValueError as e:
+        except (IOError,ValueError):
             self.seek(pos)
-            raise e
+            raise
     def writeArrays(self,arrays):
         """
         Write a number of numpy arrays to file
+        The sentinels and data of consecutive records are gathered into as few writes as possible.
         Parameters
         ----------
         arrays : iterable of ndarrays, all to be written to file.
@@ -215,8 +488,77 @@ class FortranIO(file):
         ------
         IOError : If unable to write to file
         """
+        self._offsets=[0]
+        iov=[]
         for data in arrays:
-            self.writeArray(data)
+            for piece,volatile in self._pieces(data):
+                iov.append(piece)
+                if volatile or len(iov)>=_IOV_MAX:
+                    self._writePieces(iov)
+                    iov=[]
+        self._writePieces(iov)
+
+    def _pieces(self,data):
+        """
+        Internal generator of the pieces (sentinels and data) of the record(s) holding data, in file order.
+        Yields (buffer, volatile) pairs; a volatile buffer is the scratch buffer, which is overwritten by
+        the next piece, so it must be written out before the next piece is asked for.
+        """
+        data=np.asarray(data)
+        dtype=data.dtype.newbyteorder(self._byteorder)
+        nb=data.nbytes
+        step=_SUBRECORD if self._sentinel.size==4 else max(nb,1)
+        for i in range(0,max(nb,1),step):
+            m=min(step,nb-i)
+            yield self._packMarker(m,i+step<nb),False
+            for piece in self._payload(data,dtype,i,i+m):
+                yield piece
+            yield self._packMarker(m,i>0),False
+
+    def _payload(self,data,dtype,lo,hi):
+        """
+        Internal generator of bytes lo to hi of data laid out in C order with data type dtype, as for _pieces.
+        Contiguous data in the right byte order are passed through as they are; otherwise at most
+        self._scratchsize bytes at a time are converted into the scratch buffer.
+        """
+        if data.flags.c_contiguous and data.dtype==dtype:
+            yield memoryview(data).cast("B")[lo:hi],False
+            return
+        size=dtype.itemsize
+        n=max(self._scratchsize//size,1)
+        if self._scratch is None or len(self._scratch)<n*size:
+            self._scratch=np.empty(n*size,np.uint8)
+        buf=self._scratch[:n*size].view(dtype)
+        flat=data.reshape(-1) if data.flags.c_contiguous else data.flat
+        first=lo//size
+        last=-(-hi//size)
+        for a in range(first,last,n):
+            b=min(a+n,last)
+            buf[:b-a]=flat[a:b]
+            yield memoryview(buf).cast("B")[max(lo-a*size,0):min(hi-a*size,(b-a)*size)],True
+
+    def _writePieces(self,iov):
+        """
+        Internal method to write a list of buffers, through the file buffer if they are small and
+        with os.writev if they are large.
+        """
+        nb=sum(len(b) for b in iov)
+        if not self._gather or nb<_GATHER:
+            for b in iov:
+                self._file.write(b)
+            return
+        self._file.flush()
+        fd=self._file.fileno()
+        i=0
+        while i<len(iov):
+            n=os.writev(fd,iov[i:i+_IOV_MAX])
+            while i<len(iov) and n>=len(iov[i]):
+                n-=len(iov[i])
+                i+=1
+            if n:
+                iov[i]=iov[i][n:]
+        # bring the file object back in step with the file descriptor
+        self._file.seek(os.lseek(fd,0,os.SEEK_CUR))
 
     def advance(self,n=1):
         """
@@ -236,56 +578,151 @@ class FortranIO(file):
         pos=self.tell()
         try:
             for i in range(n):
-                nb=self._readSentinel()
-                self.seek(nb,1) #seek from the current position
-                self._checkSentinel(nb)
-        except IOError as e:
+                self._recordSegments()
+        except IOError:
             self.seek(pos)
-            raise e
+            raise
 
 
-    def readArray(self,dtype,shape=None):
+    def readArray(self,dtype=None,shape=None,out=None):
         """
         Read a numpy array from a fortran file.
         If the read fails the file pointer remains where it started
 
         Parameters
         ----------
-        dtype : type, The numpy data type of the array to be read.
+        dtype : type, The numpy data type of the array to be read (default: out.dtype).
         shape : (optional) shape to reshape the read array into
+        out : (optional) C-contiguous ndarray of the same size in bytes as the record to read into.
+              Its byte order need not be that of the file; it is swapped in place if it differs,
+              so that reading repeatedly into the same buffer allocates nothing.
 
         Returns
         -------
-        data : ndarray, of data type dtype, read from the file, possibly reshaped
+        data : ndarray, of data type dtype, read from the file, possibly reshaped.
+               Unless out is given, the byte order of data is that of the file.
 
         Raises
         ------
         IOError : If unable to read from file.
-        ValueError : If cannot reshape array into desired shape.
+        ValueError : If cannot reshape array into desired shape, or out does not match the record.
         """
         pos=self.tell()
         try:
-            nb=self._readSentinel()
-            n = nb//np.nbytes[dtype]
-
-            if n*np.nbytes[dtype]!=nb:
-                raise IOError("Fortran array format not correct")
-            data=np.fromfile(self,dtype,n)
-            if not len(data)==n:
-                raise IOError("Fortran array format not correct")
-            self._checkSentinel(nb)
-            if self.swap:
-                data=data.byteswap()
+            nb,more=self._readMarker()
+            if more:
+                # a record split into subrecords
+                self.seek(pos)
+                segments=self._recordSegments()
+                nb=sum(n for p,n in segments)
+            if out is None:
+                dtype=np.dtype(dtype).newbyteorder(self._byteorder)
+                n=nb//dtype.itemsize
+                if n*dtype.itemsize!=nb:
+                    raise IOError("Fortran array format not correct")
+                data=np.empty(n,dtype)
+            else:
+                data=out
+                if dtype is not None and np.dtype(dtype).newbyteorder("<")!=data.dtype.newbyteorder("<"):
+                    raise ValueError("out has data type %s, not %s" % (data.dtype,np.dtype(dtype)))
+                if not data.flags.c_contiguous:
+                    raise ValueError("out must be C-contiguous")
+                if data.nbytes!=nb:
+                    raise ValueError("out has %d bytes, the Fortran record %d" % (data.nbytes,nb))
+            if more:
+                self._readSegments(segments,data)
+            else:
+                self._readInto(data)
+                self._checkSentinel(nb)
+            if data.dtype!=data.dtype.newbyteorder(self._byteorder):
+                data.byteswap(inplace=True)
             if shape is not None:
                 data=data.reshape(shape)
             return data
-        except IOError as err:
+        except (IOError,ValueError):
             self.seek(pos)
-            raise err
+            raise
+
+    def readRecord(self,dtype,out=None):
+        """
+        Read a record that packs fields of mixed types, e.g. integer idate(4), real fhour, character*8 label,
+        straight into a numpy structured array.  The fields are decoded with the byte order of the file.
+        If the read fails the file pointer remains where it started
+
+            hdr = f.readRecord([('idate', 'i4', 4), ('fhour', 'f4'), ('label', 'S8')])
+            idate, fhour = hdr['idate'][0], hdr['fhour'][0]
+
+        Parameters
+        ----------
+        dtype : structured numpy data type (or its specification) of the fields in the record
+        out : (optional) structured ndarray to read into, as for readArray
+
+        Returns
+        -------
+        data : 1D structured ndarray, one element per repeat of the fields in the record
+
+        Raises
+        ------
+        IOError : If unable to read from file or the record length is not a multiple of the size of dtype.
+        ValueError : If dtype is not structured, or out does not match the record.
+        """
+        dtype=np.dtype(dtype)
+        if dtype.names is None:
+            raise ValueError("readRecord needs a structured data type, not %s; use readArray" % dtype)
+        return self.readArray(dtype,out=out)
+
+    def readRecords(self,dtype,n=None):
+        """
+        Read n consecutive records that all have the same layout with one vectorised read.
+        The sentinels are read along with the data and checked all at once.
+        If the read fails the file pointer remains where it started
+
+            obs = f.readRecords([('lat', 'f4'), ('lon', 'f4'), ('val', 'f4'), ('qc', 'i4')])
+            obs['lat']
+
+        Parameters
+        ----------
+        dtype : numpy data type of the records, usually structured;
+                the length of the first record sets how many items of dtype are in each record
+        n : (optional) int, number of records to read (default: the rest of the file)
+
+        Returns
+        -------
+        data : ndarray of data type dtype, of shape (n,) or (n, items per record).
+               It is a view on the buffer read, which also holds the sentinels.
+
+        Raises
+        ------
+        IOError : If unable to read from file, or the records are not all alike.
+        """
+        dtype=np.dtype(dtype).newbyteorder(self._byteorder)
+        sentinel=np.dtype(self.sentinel).newbyteorder(self._byteorder)
+        pos=self.tell()
+        try:
+            nb=self._readSentinel()
+            self.seek(pos)
+            m=nb//dtype.itemsize
+            if m*dtype.itemsize!=nb or m==0:
+                raise IOError("Fortran array format not correct")
+            layout=np.dtype([("head",sentinel),("data",dtype,(m,) if m>1 else ()),("tail",sentinel)])
+            if n is None:
+                n,left=divmod(self.seek(0,io.SEEK_END)-pos,layout.itemsize)
+                self.seek(pos)
+                if left:
+                    raise IOError("Fortran records are not all alike")
+            data=np.empty(n,layout)
+            self._readInto(data)
+            if not (np.all(data["head"]==nb) and np.all(data["tail"]==nb)):
+                raise IOError("Fortran records are not all alike")
+            return data["data"]
+        except IOError:
+            self.seek(pos)
+            raise
 
     def writeArray(self,data):
         """
         Write a numpy array to file
+        With a 32-bit sentinel, arrays of more than 2**31-9 bytes are written as gfortran subrecords.
         Parameters
         ----------
         data : ndarray, data to be written to file
@@ -298,12 +735,968 @@ class FortranIO(file):
         ------
         IOError : If unable to write to file
         """
-        data=np.array(data)
-        nb=np.array(data.nbytes,dtype=self.sentinel)
-        if self.swap:
-            nb = nb.byteswap()
-            data = data.byteswap()
-        nb.tofile(self)
-        data.tofile(self)
-        nb.tofile(self)
+        self.writeArrays([data])
+
+    def iter_record_chunks(self,dtype=np.uint8,chunksize=2**26):
+        """
+        Stream the record at the current position in chunks of bounded size,
+        without holding the whole record in memory.  Records split into subrecords
+        are streamed across the subrecord boundaries.
+
+            total = 0.0
+            for chunk in f.iter_record_chunks(np.float32):
+                total += chunk.sum(dtype=np.float64)
+
+        Each chunk is a view on one buffer that is reused for the next chunk; copy it to keep it.
+        Once the generator is exhausted the file is positioned after the record.  If it is closed
+        early, or a read fails, the file pointer returns to where it started.
+
+        Parameters
+        ----------
+        dtype : (optional) type, The numpy data type of the chunks (default: uint8); its byte order is that of the file
+        chunksize : (optional) int, maximum size of a chunk in bytes (default: 64 MiB)
+
+        Yields
+        ------
+        chunk : 1D ndarray of data type dtype
+
+        Raises
+        ------
+        IOError : If unable to read from file, fortran format not correct,
+                  or the record length is not a multiple of the size of dtype.
+        """
+        dtype=np.dtype(dtype).newbyteorder(self._byteorder)
+        buf=np.empty(max(chunksize//dtype.itemsize,1),dtype)
+        mv=memoryview(buf).cast("B")
+        pos=self.tell()
+        done=False
+        try:
+            nb,more=self._readMarker()
+            left=nb
+            while True:
+                n=0
+                while n<len(mv) and (left or more):
+                    if not left:
+                        # end of a subrecord; on to the next one
+                        if self._readMarker()[0]!=nb:
+                            raise SentinelError("Incorrect sentinel in Fortran File")
+                        nb,more=self._readMarker()
+                        left=nb
+                        continue
+                    m=min(left,len(mv)-n)
+                    self._readInto(mv[n:n+m])
+                    n+=m
+                    left-=m
+                if n%dtype.itemsize!=0:
+                    raise IOError("Fortran array format not correct")
+                if n:
+                    yield buf[:n//dtype.itemsize]
+                if not (left or more):
+                    break
+            if self._readMarker()[0]!=nb:
+                raise SentinelError("Incorrect sentinel in Fortran File")
+            done=True
+        finally:
+            if not done:
+                self.seek(pos)
+
+    def _recordOffset(self,k):
+        """
+        Internal method returning the position of the leading sentinel of record k.
+        The sentinels are walked (without reading the data) only as far as they have not been before;
+        self._offsets holds the position of every record walked so far, and of the end of the last one.
+        The file position is left unchanged.
+        Parameters
+        ----------
+        k : int, the record number
+
+        Returns
+        -------
+        pos : int, position of record k in the file
+
+        Raises
+        ------
+        IndexError : If the file has fewer than k+1 records.
+        IOError : If fortran format not correct.
+        """
+        if k<0:
+            raise IndexError("record number must be non-negative, not %d" % k)
+        pos=self.tell()
+        try:
+            self.seek(self._offsets[-1])
+            while len(self._offsets)<=k+1:
+                if not self.read(1):
+                    raise IndexError("record %d out of range for %d records" % (k,len(self._offsets)-1))
+                self.seek(-1,1)
+                self.advance(1)
+                self._offsets.append(self.tell())
+        finally:
+            self.seek(pos)
+        return self._offsets[k]
+
+    def record(self,k,dtype,shape=None):
+        """
+        Return a lazy proxy for record k.
+        Nothing is read until the proxy is sliced; then only the bytes of the requested slice are read,
+        so that memory use is proportional to the slice and not the record:
+
+            lev = f.record(12, np.float32, (nz, ny, nx))[5]
+            box = f.record(12, np.float32, (nz, ny, nx))[:, 100:200, 300:400:2]
+
+        Parameters
+        ----------
+        k : int, the record number (counting from the start of the file)
+        dtype : type, The numpy data type of the record; its byte order is that of the file
+        shape : (optional) shape of the record (default: 1D)
+
+        Returns
+        -------
+        rec : FortranRecord
+
+        Raises
+        ------
+        IndexError : If the file has fewer than k+1 records.
+        IOError : If fortran format not correct.
+        ValueError : If the record does not hold an array of this data type and shape.
+        """
+        pos=self.tell()
+        try:
+            self.seek(self._recordOffset(k))
+            segments=self._recordSegments()
+        finally:
+            self.seek(pos)
+        return FortranRecord(self,segments,dtype,shape)
+
+
+def readEnsemble(names,record,dtype,shape=None,out=None,workers=None,endian="=",sentinel=np.uint32):
+    """
+    Read the same record from a number of files (e.g. ensemble members) concurrently on a thread pool.
+    Each file is read with readinto straight into its slot of one preallocated array; the reads do not
+    hold the GIL, so they overlap.
+
+        ens = readEnsemble(['mem%03d.bin' % m for m in range(1, 81)], 12, np.float32, (ny, nx), endian='>')
+
+    Parameters
+    ----------
+    names : list of filenames
+    record : int, the number of the record to read from each file,
+             or a function that takes an open FortranIO and positions it at the record to read
+    dtype : type, The numpy data type of the record
+    shape : (optional) shape of the record (default: 1D, from the record length in the first file)
+    out : (optional) C-contiguous ndarray of shape (len(names),)+shape to read into
+    workers : (optional) int, maximum number of threads (default: that of concurrent.futures.ThreadPoolExecutor)
+    endian : '=', '!', '>', '<' or 'auto', as for FortranIO
+    sentinel : the data type of the sentinel used in the files, or 'auto', as for FortranIO
+
+    Returns
+    -------
+    out : ndarray of shape (len(names),)+shape, in native byte order unless out was given
+
+    Raises
+    ------
+    IOError : If unable to read from a file.
+    IndexError : If a file has too few records.
+    ValueError : If a record does not fit the shape.
+    """
+    if isinstance(record,(int,np.integer)):
+        k=record
+        record=lambda f:f.seek(f._recordOffset(k))
+    if out is None:
+        dtype=np.dtype(dtype)
+        if shape is None:
+            with FortranIO(names[0],endian=endian,sentinel=sentinel) as f:
+                record(f)
+                shape=(sum(nb for pos,nb in f._recordSegments())//dtype.itemsize,)
+        out=np.empty((len(names),)+tuple(np.atleast_1d(shape).tolist()),dtype)
+
+    def read(i):
+        with FortranIO(names[i],endian=endian,sentinel=sentinel) as f:
+            record(f)
+            f.readArray(dtype,out=out[i])
+
+    with ThreadPoolExecutor(workers) as pool:
+        for result in [pool.submit(read,i) for i in range(len(names))]:
+            result.result()
+    return out
+
+
+def _chunkShape(shape,itemsize,target=2**22):
+    """
+    Internal function to choose a chunk shape for records of shape: the whole record, with the leading
+    axes halved in turn until a chunk holds no more than target bytes.
+    """
+    chunks=list(shape)
+    for i in range(len(chunks)):
+        while chunks[i]>1 and int(np.prod(chunks))*itemsize>target:
+            chunks[i]=-(-chunks[i]//2)
+    return tuple(chunks)
+
+def transcode(name,dest,dtype,shape,fmt="netcdf",skip=0,nrec=None,chunks=None,complevel=4,
+              vname="data",dims=None,endian="=",sentinel=np.uint32):
+    """
+    Transcode the records of a Fortran unformatted file, all of the same data type and shape,
+    into a chunked on-disk array of shape (nrec,)+shape that can be read back in parts.
+    The records are read one at a time into a single buffer, so memory use does not grow with the file.
+
+        transcode('fcst.bin', 'fcst.nc', np.float32, (nz, ny, nx), skip=1, endian='>')
+        transcode('fcst.bin', 'fcst.npy.d', np.float32, (nz, ny, nx), fmt='npy', skip=1, endian='>')
+
+    fmt='netcdf' writes the netCDF4 variable vname with an unlimited 'record' dimension,
+    one record per chunk along it, and zlib compression with the byte shuffle filter.
+    fmt='npy' writes a directory holding one (uncompressed, memory-mappable) .npy file per chunk,
+    named <record>.<chunk index along each axis>.npy, and a meta.json describing the layout.
+
+    Parameters
+    ----------
+    name : the filename of the Fortran unformatted file
+    dest : the filename of the netCDF file, or the name of the directory of .npy chunks
+    dtype : type, The numpy data type of the records
+    shape : shape of the records
+    fmt : (optional) 'netcdf' (default) or 'npy'
+    skip : (optional) int, number of records (e.g. headers) to skip first (default: 0)
+    nrec : (optional) int, number of records to transcode (default: all the rest)
+    chunks : (optional) chunk shape within a record (default: the record, halved along its leading axes to at most 4 MiB)
+    complevel : (optional) int, zlib compression level for netCDF, 0 for none (default: 4)
+    vname : (optional) name of the netCDF variable (default: 'data')
+    dims : (optional) names of the netCDF dimensions of a record (default: 'dim0', 'dim1', ...)
+    endian : '=', '!', '>', '<' or 'auto', as for FortranIO
+    sentinel : the data type of the sentinel used in the unformatted file, or 'auto', as for FortranIO
+
+    Returns
+    -------
+    n : int, the number of records transcoded
+
+    Raises
+    ------
+    ValueError : If fmt is unknown, or a record does not fit the shape.
+    IOError : If unable to read or write.
+    """
+    if fmt not in ["netcdf","npy"]:
+        raise ValueError("fmt must be 'netcdf' or 'npy', not %s" % fmt)
+    dtype=np.dtype(dtype).newbyteorder("=")
+    shape=tuple(np.atleast_1d(shape).tolist())
+    if chunks is None:
+        chunks=_chunkShape(shape,dtype.itemsize)
+    chunks=tuple(np.atleast_1d(chunks).tolist())
+    buf=np.empty(shape,dtype)
+
+    def records(f):
+        n=0
+        while nrec is None or n<nrec:
+            if not f.read(1):
+                break
+            f.seek(-1,io.SEEK_CUR)
+            f.readArray(dtype,out=buf)
+            yield n
+            n+=1
+
+    with FortranIO(name,endian=endian,sentinel=sentinel) as f:
+        f.advance(skip)
+        n=0
+        if fmt=="netcdf":
+            from netCDF4 import Dataset
+            if dims is None:
+                dims=["dim%d" % i for i in range(len(shape))]
+            with Dataset(dest,"w") as nc:
+                nc.createDimension("record",None)
+                for dim,size in zip(dims,shape):
+                    nc.createDimension(dim,size)
+                var=nc.createVariable(vname,dtype,["record"]+list(dims),zlib=complevel>0,complevel=max(complevel,1),
+                                      shuffle=complevel>0,chunksizes=(1,)+chunks)
+                for n in records(f):
+                    var[n]=buf
+                    n+=1
+        else:
+            if not os.path.isdir(dest):
+                os.makedirs(dest)
+            grid=list(itertools.product(*[range(0,size,c) for size,c in zip(shape,chunks)]))
+            for n in records(f):
+                for starts in grid:
+                    chunk=buf[tuple(slice(a,a+c) for a,c in zip(starts,chunks))]
+                    np.save(os.path.join(dest,".".join(str(i) for i in (n,)+tuple(a//c for a,c in zip(starts,chunks)))+".npy"),chunk)
+                n+=1
+            with open(os.path.join(dest,"meta.json"),"w") as meta:
+                json.dump({"dtype":dtype.str,"shape":[n]+list(shape),"chunks":[1]+list(chunks)},meta)
+    return n
+
+
+class AsyncFortranReader(object):
+    """
+    Iterate asynchronously over the records of a Fortran unformatted file, so that reading overlaps with compute.
+
+    The next records are read ahead on a background thread while the consumer works on the current one,
+    and are handed over in order:
+
+        async with AsyncFortranReader('fcst.bin', np.float32, (ny, nx), endian='>', prefetch=4) as f:
+            async for rec in f:
+                compute(rec)
+
+    At most prefetch records, and no more than max_bytes of them (but always at least one record),
+    are held ahead of the consumer; a record no longer counts against the budget once it has been handed over.
+    Leave the async with block (or await aclose()) to stop reading ahead if the iteration is left early;
+    otherwise reading ahead stops once the reader is garbage collected or its event loop is closed.
+    The file is closed when the last record has been read.
+    """
+    def __init__(self,name,dtype,shape=None,prefetch=2,max_bytes=None,endian="=",sentinel=np.uint32):
+        """Open the file.
+        Parameters
+        ----------
+        name : the filename
+        dtype : type, The numpy data type of the records
+        shape : (optional) shape to reshape the records into
+        prefetch : (optional) int, maximum number of records read ahead (default: 2)
+        max_bytes : (optional) int, maximum number of bytes read ahead (default: no limit)
+        endian : '=', '!', '>', '<' or 'auto', as for FortranIO
+        sentinel : the data type of the sentinel used in the unformatted file, or 'auto', as for FortranIO
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        ValueError : If an endianness other than '=','!','>','<','auto' is specified
+        IOError : If unable to open the file
+        """
+        self._f=FortranIO(name,endian=endian,sentinel=sentinel)
+        self.dtype=dtype
+        self.shape=shape
+        self.prefetch=max(prefetch,1)
+        self.max_bytes=max_bytes
+        self._cond=threading.Condition()
+        self._pending=0   # number of records read ahead and not yet handed over
+        self._bytes=0     # and their size in bytes
+        self._closed=False
+        self._queue=None
+        self._done=None
+        self._executor=ThreadPoolExecutor(1)
+        weakref.finalize(self,AsyncFortranReader._wake,self._cond)
+
+    def _fits(self,nb):
+        """
+        Internal method to check whether a record of nb bytes may be read ahead.
+        """
+        if self._pending>=self.prefetch:
+            return False
+        return self.max_bytes is None or self._pending==0 or self._bytes+nb<=self.max_bytes
+
+    @staticmethod
+    def _wake(cond):
+        """
+        Internal method to wake the background thread once the reader has been garbage collected.
+        """
+        with cond:
+            cond.notify()
+
+    @staticmethod
+    def _reserve(ref,loop,nb):
+        """
+        Internal method to wait, holding the condition, until a record of nb bytes may be read ahead.
+        Returns False instead once the reader is closed or garbage collected, or its event loop is closed.
+        Only a weak reference to the reader is held while waiting, so that an abandoned reader can be collected.
+        """
+        while True:
+            self=ref()
+            if self is None or self._closed or loop.is_closed():
+                return False
+            if self._fits(nb):
+                self._pending+=1
+                self._bytes+=nb
+                return True
+            cond=self._cond
+            del self
+            cond.wait(0.1)
+
+    @staticmethod
+    def _produce(ref,loop):
+        """
+        Internal method run on the background thread: read the records in turn, as the budget allows,
+        and put them on the queue, followed by StopAsyncIteration or the error that stopped the reading.
+        Closes the file and shuts down the executor when it stops, whether at the end of the file,
+        on aclose, or because the consumer went away.
+        """
+        self=ref()
+        f,cond,queue,executor=self._f,self._cond,self._queue,self._executor
+        dtype,shape=self.dtype,self.shape
+        del self
+        try:
+            try:
+                while True:
+                    pos=f.tell()
+                    if not f.read(1):
+                        break
+                    f.seek(pos)
+                    nb=sum(n for p,n in f._recordSegments())
+                    f.seek(pos)
+                    with cond:
+                        if not AsyncFortranReader._reserve(ref,loop,nb):
+                            return
+                    data=f.readArray(dtype,shape)
+                    loop.call_soon_threadsafe(queue.put_nowait,data)
+                item=StopAsyncIteration()
+            except Exception as e:
+                item=e
+            loop.call_soon_threadsafe(queue.put_nowait,item)
+        except RuntimeError:
+            # the event loop was closed under us
+            pass
+        finally:
+            f.close()
+            executor.shutdown(wait=False)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._queue is None:
+            loop=asyncio.get_event_loop()
+            self._queue=asyncio.Queue()
+            self._done=loop.run_in_executor(self._executor,AsyncFortranReader._produce,weakref.ref(self),loop)
+        item=await self._queue.get()
+        if isinstance(item,BaseException):
+            # keep it for any later call
+            self._queue.put_nowait(item)
+            raise item
+        with self._cond:
+            self._pending-=1
+            self._bytes-=item.nbytes
+            self._cond.notify()
+        return item
+
+    async def aclose(self):
+        """
+        Stop reading ahead and close the file.
+        """
+        with self._cond:
+            self._closed=True
+            self._cond.notify()
+        if self._done is not None:
+            await self._done
+        self._executor.shutdown()
+        self._f.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self,*args):
+        await self.aclose()
+
+
+class FortranRecord(object):
+    """
+    A lazy proxy for one record of a FortranIO file, as returned by FortranIO.record.
+
+    Indexing the proxy with integers, slices (with any step) and Ellipsis reads just the bytes needed
+    for that hyperslab.  Runs of the record that are contiguous on disk are read with one readinto each,
+    straight into the result; a strided selection along an outer axis is read as one run per selected
+    index.  A step along the last axis reads its span a bounded window (_scratchsize bytes) at a time into
+    scratch and subsamples it, or, for steps of at least a file buffer, reads the selected elements one by one,
+    so memory scales with the hyperslab, not the record.
+    The file position of the FortranIO is left unchanged.
+    """
+    # size of the scratch window for strided reads along the last axis
+    _scratchsize=2**20
+
+    def __init__(self,f,segments,dtype,shape=None):
+        """
+        Parameters
+        ----------
+        f : FortranIO, the file the record is in
+        segments : list of (position, number of bytes) of the data of each subrecord of the record
+        dtype : type, The numpy data type of the record; its byte order is that of f
+        shape : (optional) shape of the record (default: 1D)
+
+        Raises
+        ------
+        ValueError : If the record does not hold an array of this data type and shape.
+        """
+        self._f=f
+        self.segments=segments
+        self._starts=np.cumsum([0]+[nb for pos,nb in segments]).tolist()
+        self.nbytes=nbytes=self._starts[-1]
+        self.dtype=np.dtype(dtype).newbyteorder(f._byteorder)
+        if shape is None:
+            shape=(nbytes//self.dtype.itemsize,)
+        self.shape=tuple(np.atleast_1d(shape).tolist())
+        if int(np.prod(self.shape))*self.dtype.itemsize!=nbytes:
+            raise ValueError("Fortran record of %d bytes cannot hold %s of %s" % (nbytes,self.shape,self.dtype))
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __array__(self,dtype=None,copy=None):
+        data=self.read()
+        return data if dtype is None else data.astype(dtype,copy=False)
+
+    def read(self):
+        """
+        Read the whole record.
+        """
+        return self[...]
+
+    def _readAt(self,start,buf):
+        """
+        Internal method to fill buf with the data bytes of the record starting at byte start.
+        """
+        mv=memoryview(buf).cast("B")
+        n=0
+        for (pos,nb),first in zip(self.segments,self._starts):
+            lo=start+n-first
+            if 0<=lo<nb and n<len(mv):
+                m=min(nb-lo,len(mv)-n)
+                self._f.seek(pos+lo)
+                self._f._readInto(mv[n:n+m])
+                n+=m
+
+    def _index(self,key):
+        """
+        Internal method to turn key into one array of selected indices per axis,
+        and the list of axes that are dropped (those indexed with an integer).
+        """
+        if not isinstance(key,tuple):
+            key=(key,)
+        if sum(k is Ellipsis for k in key)>1:
+            raise IndexError("an index can only have a single ellipsis ('...')")
+        if Ellipsis in key:
+            i=key.index(Ellipsis)
+            key=key[:i]+(slice(None),)*(self.ndim-len(key)+1)+key[i+1:]
+        if len(key)>self.ndim:
+            raise IndexError("too many indices for record of shape %s" % (self.shape,))
+        key=key+(slice(None),)*(self.ndim-len(key))
+        indices=[]
+        dropped=[]
+        for axis,(k,n) in enumerate(zip(key,self.shape)):
+            if isinstance(k,slice):
+                indices.append(np.arange(*k.indices(n)))
+            elif isinstance(k,(int,np.integer)):
+                if not -n<=k<n:
+                    raise IndexError("index %d is out of bounds for axis %d with size %d" % (k,axis,n))
+                indices.append(np.array([k%n]))
+                dropped.append(axis)
+            else:
+                raise IndexError("only integers, slices and ellipsis are valid indices for a Fortran record")
+        return indices,dropped
+
+    def __getitem__(self,key):
+        indices,dropped=self._index(key)
+        out=np.empty([len(i) for i in indices],self.dtype)
+        pos=self._f.tell()
+        try:
+            self._read(indices,out)
+        finally:
+            self._f.seek(pos)
+        if dropped:
+            out=out.reshape([len(i) for a,i in enumerate(indices) if a not in dropped])
+        return out
+
+    def _read(self,indices,out):
+        """
+        Internal method to read the hyperslab selected by indices into out.
+        """
+        if not out.size:
+            return
+        # trailing axes that are selected whole are contiguous on disk;
+        # the selections are evenly spaced, so a whole axis is one of full length with a step of 1
+        k=self.ndim
+        while k>0 and len(indices[k-1])==self.shape[k-1] and (self.shape[k-1]<2 or indices[k-1][1]-indices[k-1][0]==1):
+            k-=1
+        if k==0:
+            self._readAt(0,out)
+            return
+        strides=np.cumprod((self.shape[1:]+(1,))[::-1])[::-1]*self.dtype.itemsize
+        sel=indices[k-1]
+        lo=int(sel.min())
+        if np.all(np.diff(sel)==1):
+            for idx in np.ndindex(*out.shape[:k-1]):
+                start=lo*int(strides[k-1])+sum(int(indices[i][j])*int(strides[i]) for i,j in enumerate(idx))
+                self._readAt(start,out[idx])
+        elif k<self.ndim:
+            # strided outer axis: each selected index is a contiguous run of the trailing axes
+            for idx in np.ndindex(*out.shape[:k]):
+                start=sum(int(indices[i][j])*int(strides[i]) for i,j in enumerate(idx))
+                self._readAt(start,out[idx])
+        else:
+            # strided last axis: elements at least a file buffer apart are read one by one; closer ones
+            # are read a window of at most _scratchsize bytes at a time into scratch and subsampled
+            itemsize=self.dtype.itemsize
+            step=abs(int(sel[1])-int(sel[0]))
+            per=max(self._scratchsize//(step*itemsize),1) if step*itemsize<io.DEFAULT_BUFFER_SIZE else 1
+            scratch=np.empty((per-1)*step+1,self.dtype) if per>1 else None
+            # walk the selection in file order
+            order=slice(None) if sel[0]<sel[-1] else slice(None,None,-1)
+            sel=sel[order]
+            for idx in np.ndindex(*out.shape[:k-1]):
+                row=sum(int(indices[i][j])*int(strides[i]) for i,j in enumerate(idx))
+                dest=out[idx][order]
+                for j in range(0,len(sel),per):
+                    first=int(sel[j])
+                    if scratch is None:
+                        self._readAt(row+first*itemsize,dest[j:j+1])
+                    else:
+                        n=int(sel[min(j+per,len(sel))-1])-first+1
+                        self._readAt(row+first*itemsize,scratch[:n])
+                        dest[j:j+per]=scratch[:n:step]
+
+
+class FortranMap(object):
+    """
+    Random access to the records of a Fortran "unformatted" file through a read-only memory map.
+
+    The sentinels are walked once when the file is opened, and the data offset and byte length of every
+    record is kept in a table (self.offsets, self.lengths).  Records are then served as numpy arrays
+    that are views on the memory map, so that indexing, slicing and iterating over records costs O(1)
+    per record and issues no read calls; pages are only brought in when the data is touched.
+
+        f = FortranMap('restart.bin', endian='>')
+        raw = f[3000]                                   # uint8 view of record 3000
+        fld = f.readArray(3000, np.float32, (ny, nx))   # typed view of record 3000
+        for rec in f[10:20]:
+            ...
+
+    The returned arrays are read-only.  Copy them if they need to outlive the FortranMap.
+    Records split into gfortran subrecords are not contiguous in the file; they are the exception
+    and are returned as (writable) copies.  Their subrecords are listed in self.segments.
+
+    The record table can be persisted in a small sidecar file (index=True), so that only the first
+    process to open a file pays for the scan:
+
+        f = FortranMap('restart.bin', endian='>', index=True)   # reads or writes restart.bin.idx
+    """
+    def __init__(self,name,endian="=",sentinel=np.uint32,dtype=np.uint8,index=None):
+        """Open the file and build the record table.
+        Parameters
+        ----------
+        name : the filename
+        endian : '=', '!', '>', '<' or 'auto', as for FortranIO
+        sentinel : the data type of the sentinel used in the unformatted file, or 'auto', as for FortranIO
+        dtype : (optional) the numpy data type in which records are returned by indexing (default: uint8)
+        index : (optional) None to always scan the file (default),
+                True to use the sidecar record index name+'.idx',
+                or the filename of the sidecar record index.
+                A sidecar that matches the size and modification time of the file is read instead of scanning;
+                otherwise the file is scanned and the sidecar (re)written.
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        ValueError : If an endianness other than '=','!','>','<' is specified
+        SentinelError : If the file is not correctly formatted, or its endianness or sentinel cannot be detected
+        IOError : If unable to open the file
+        """
+        self.name=name
+        self._file=open(name,"rb")
+        try:
+            if "auto" in (endian,sentinel):
+                endian,sentinel=_detect(self._file,endian,sentinel)
+            self.dtype=np.dtype(dtype).newbyteorder(_byteorder(endian))
+        except (IOError,ValueError):
+            self._file.close()
+            raise
+        self.endian=endian
+        self.sentinel=sentinel
+        try:
+            self._map=mmap.mmap(self._file.fileno(),0,access=mmap.ACCESS_READ)
+        except ValueError:
+            # an empty file cannot be mapped
+            self._map=b""
+        if index is True:
+            index=name+".idx"
+        try:
+            if index is None or not self._readIndex(index):
+                self.offsets,self.lengths,self.segments=self._scan()
+                if index is not None:
+                    try:
+                        self.writeIndex(index)
+                    except IOError:
+                        # the sidecar is only a cache; carry on with the scanned table
+                        pass
+        except IOError:
+            self.close()
+            raise
+
+    def _scan(self):
+        """
+        Internal method to walk the sentinels of the whole file.
+        Parameters
+        ----------
+        None
+
+        Returns
+        -------
+        offsets : ndarray of int64, the byte offset of the data of each record
+        lengths : ndarray of int64, the number of data bytes in each record
+        segments : (n,3) ndarray of int64, the record number, byte offset and number of data bytes
+                   of each subrecord of the records that are split into subrecords
+
+        Raises
+        ------
+        SentinelError
+            if a sentinel is missing or incorrect
+        """
+        sentinel=_sentinelStruct(self.endian,self.sentinel)
+        ssize=sentinel.size
+        size=len(self._map)
+        offsets=[]
+        lengths=[]
+        segments=[]
+        pos=0
+        while pos<size:
+            subrecords=[]
+            more=True
+            while more:
+                if pos+ssize>size:
+                    raise SentinelError("Fortran sentinel not found.")
+                nb,more=_marker(sentinel.unpack_from(self._map,pos)[0],ssize)
+                end=pos+ssize+nb
+                if end+ssize>size:
+                    raise SentinelError("Fortran sentinel not found.")
+                if _marker(sentinel.unpack_from(self._map,end)[0],ssize)[0]!=nb:
+                    raise SentinelError("Incorrect sentinel in Fortran File")
+                subrecords.append((len(offsets),pos+ssize,nb))
+                pos=end+ssize
+            offsets.append(subrecords[0][1])
+            lengths.append(sum(nb for k,p,nb in subrecords))
+            if len(subrecords)>1:
+                segments.extend(subrecords)
+        return (np.array(offsets,dtype=np.int64),np.array(lengths,dtype=np.int64),
+                np.array(segments,dtype=np.int64).reshape(-1,3))
+
+    def _stat(self):
+        """
+        Internal method returning the (size, mtime in ns) of the file, against which a sidecar index is checked.
+        """
+        st=os.fstat(self._file.fileno())
+        return st.st_size,st.st_mtime_ns
+
+    def _readIndex(self,fname):
+        """
+        Internal method to read the record table from a sidecar index.
+        Parameters
+        ----------
+        fname : the filename of the sidecar index
+
+        Returns
+        -------
+        found : True if the sidecar index exists and matches the file and its endianness and sentinel,
+                in which case self.offsets, self.lengths and self.segments are set.  False otherwise,
+                including when the sidecar is truncated, corrupt or not an index at all.
+        """
+        try:
+            with np.load(fname) as idx:
+                header=(int(idx["size"]),int(idx["mtime"]),str(idx["endian"]),str(idx["sentinel"]))
+                if header!=self._stat()+(_byteorder(self.endian),np.dtype(self.sentinel).name):
+                    return False
+                self.offsets=idx["offsets"]
+                self.lengths=idx["lengths"]
+                self.segments=idx["segments"]
+        except (IOError,ValueError,KeyError,EOFError,zipfile.BadZipFile):
+            return False
+        return True
+
+    def writeIndex(self,fname=None):
+        """
+        Write the record table to a sidecar index.
+        The offsets and byte lengths of the records are saved along with the endianness and sentinel type
+        they were read with, and the size and modification time of the file they describe.
+        The sidecar is written to a temporary file first and then renamed, so that concurrent readers
+        never see a partial index.
+
+        Parameters
+        ----------
+        fname : (optional) the filename of the sidecar index (default: self.name+'.idx')
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        IOError : If unable to write the sidecar index.
+        """
+        if fname is None:
+            fname=self.name+".idx"
+        size,mtime=self._stat()
+        fd,tmp=tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)),suffix=".tmp")
+        try:
+            with os.fdopen(fd,"wb") as fh:
+                np.savez(fh,offsets=self.offsets,lengths=self.lengths,segments=self.segments,
+                         endian=_byteorder(self.endian),sentinel=np.dtype(self.sentinel).name,
+                         size=size,mtime=mtime)
+            os.replace(tmp,fname)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self,k):
+        """
+        Return record k (an int) as a view of type self.dtype,
+        or a list of such views if k is a slice.
+        """
+        if isinstance(k,slice):
+            return [self.readArray(i,self.dtype) for i in range(*k.indices(len(self)))]
+        return self.readArray(k,self.dtype)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.readArray(i,self.dtype)
+
+    def readArray(self,k,dtype,shape=None):
+        """
+        Return record k as a numpy array view on the memory map.
+        Byte order is handled through the data type of the view; the data are never swapped or copied,
+        except for a record split into subrecords, which is gathered into a new array.
+
+        Parameters
+        ----------
+        k : int, the record number (negative numbers count from the end)
+        dtype : type, The numpy data type of the array
+        shape : (optional) shape to reshape the array into
+
+        Returns
+        -------
+        data : ndarray of data type dtype, possibly reshaped; read-only unless split into subrecords
+
+        Raises
+        ------
+        IndexError : If there is no record k.
+        IOError : If the record length is not a multiple of the size of dtype.
+        ValueError : If cannot reshape array into desired shape.
+        """
+        if k<0:
+            k+=len(self)
+        if not 0<=k<len(self):
+            raise IndexError("record %d out of range for %d records" % (k,len(self)))
+        dtype=np.dtype(dtype).newbyteorder(_byteorder(self.endian))
+        nb=int(self.lengths[k])
+        if nb%dtype.itemsize!=0:
+            raise IOError("Fortran array format not correct")
+        subrecords=self.segments[self.segments[:,0]==k]
+        if len(subrecords):
+            data=np.empty(nb//dtype.itemsize,dtype)
+            buf=data.view(np.uint8)
+            for i,(k,pos,n) in zip(np.cumsum(subrecords[:,2])-subrecords[:,2],subrecords):
+                buf[i:i+n]=np.frombuffer(self._map,np.uint8,n,pos)
+        else:
+            data=np.frombuffer(self._map,dtype,nb//dtype.itemsize,int(self.offsets[k]))
+        if shape is not None:
+            data=data.reshape(shape)
+        return data
+
+    def close(self):
+        """
+        Release the memory map and close the file.
+        The map stays alive until arrays still viewing it are garbage collected.
+        """
+        if isinstance(self._map,mmap.mmap):
+            try:
+                self._map.close()
+            except BufferError:
+                # views are still exported; the map is released with the last of them
+                pass
+        self._map=b""
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+
+class FortranDirect(object):
+    """
+    Read a Fortran access='direct' file: fixed-length records with no sentinels, as also written for GrADS.
+
+    The file is exposed as an np.memmap-backed array indexed as [record, ...], so that only the pages
+    holding the requested elements are ever read from disk:
+
+        f = FortranDirect('fcst.dat', np.float32, (nz, ny, nx), endian='>', undef=-9.99e8)
+        lev = f[t, 5]        # level 5 of record t, masked where undefined
+        ts = f[:, 5, 10, 20]  # a time series at one grid point
+
+    Records may be longer than the data they hold (recl); the padding is skipped.
+    """
+    def __init__(self,name,dtype,shape,recl=None,offset=0,endian="=",undef=None,mode="r"):
+        """Map the file.
+        Parameters
+        ----------
+        name : the filename
+        dtype : type, The numpy data type of the data in a record
+        shape : shape of the data in a record
+        recl : (optional) int, the record length in bytes (default: the size of the data)
+        offset : (optional) int, the number of bytes before the first record (default: 0)
+        endian : '=', '!', '>' or '<', as for FortranIO
+        undef : (optional) value marking undefined data; if given, indexing returns masked arrays
+        mode : (optional) 'r' to read (default), or 'r+' to also update the file in place
+
+        Returns
+        -------
+        None
+
+        Raises
+        ------
+        ValueError : If an endianness other than '=','!','>','<' is specified,
+                     or the record length is shorter than the data.
+        IOError : If unable to open the file
+        """
+        self.name=name
+        self.dtype=np.dtype(dtype).newbyteorder(_byteorder(endian))
+        self.shape=tuple(np.atleast_1d(shape).tolist())
+        nbytes=int(np.prod(self.shape))*self.dtype.itemsize
+        if recl is None:
+            recl=nbytes
+        if recl<nbytes:
+            raise ValueError("record length %d is shorter than the %d bytes of data" % (recl,nbytes))
+        self.recl=recl
+        self.offset=offset
+        self.undef=undef
+        nrec=max(os.path.getsize(name)-offset,0)//recl
+        if nrec==0:
+            # np.memmap cannot map an empty range
+            self.data=np.empty((0,)+self.shape,self.dtype)
+            return
+        record=np.dtype([("data",self.dtype,self.shape),("pad","V%d" % (recl-nbytes))]) if recl>nbytes else self.dtype
+        self._map=np.memmap(name,record,mode,offset,(nrec,) if recl>nbytes else (nrec,)+self.shape)
+        self.data=self._map["data"] if recl>nbytes else self._map
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self,key):
+        """
+        Return the data selected by key, indexed as [record, ...], as a view on the file;
+        masked where undefined if undef was given.
+        """
+        data=self.data[key]
+        if self.undef is None:
+            return data
+        if np.isnan(self.undef):
+            return np.ma.masked_invalid(data,copy=False)
+        return np.ma.masked_equal(data,self.undef,copy=False)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        """
+        Release the memory map.  Arrays still viewing it keep it alive until they are garbage collected.
+        """
+        self.data=np.empty((0,)+self.shape,self.dtype)
+        self._map=None
+
+    def __enter__(self):
+        return self
 
+    def __exit__(self,*args):
+        self.close()
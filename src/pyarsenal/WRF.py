@@ -15,7 +15,7 @@ __all__ = ['ddx', 'ddy', 'vorticity',
 
 import math as _math
 import numpy as _np
-from netCDF4 import Dataset as _Dataset
+from .netCDF import pooled_dataset as _pooled_dataset
 
 pid = _math.pi / 180.0
 R_earth = 6370.0 * 1.0e3
@@ -44,34 +44,32 @@ def wrf_proj(filename):
 
     proj = type('WRF_PROJECTION', (), {})
 
-    nc = _Dataset(filename, 'r')
-
-    proj.code = int(nc.MAP_PROJ)
-    proj.nx = len(nc.dimensions['west_east'])
-    proj.ny = len(nc.dimensions['south_north'])
-    if ('bottom_top' in nc.dimensions):
-        proj.nz = len(nc.dimensions['bottom_top'])
-    proj.dx = float(nc.DX)
-    proj.dy = float(nc.DY)
-    proj.cenlat = float(nc.CEN_LAT)
-    proj.cenlon = float(nc.CEN_LON)
-    proj.stdlat1 = float(nc.TRUELAT1)
-    proj.stdlat2 = float(nc.TRUELAT2)
-    proj.stdlon = float(nc.STAND_LON)
-
-    if 'XLAT' in nc.variables:
-        proj.xlat = _np.squeeze(nc.variables["XLAT"][:])
-        tmp = _np.squeeze(nc.variables["XLONG"][:])
-        proj.xlon = (tmp < 0.0) * 360.0 + tmp
-    elif 'XLAT_M' in nc.variables:
-        proj.xlat = _np.squeeze(nc.variables["XLAT_M"][:])
-        tmp = _np.squeeze(nc.variables["XLONG_M"][:])
-        proj.xlon = (tmp < 0.0) * 360.0 + tmp
-
-    proj.lat1 = proj.xlat[0, 0]
-    proj.lon1 = proj.xlon[0, 0]
-
-    nc.close()
+    with _pooled_dataset(filename) as nc:
+
+        proj.code = int(nc.MAP_PROJ)
+        proj.nx = len(nc.dimensions['west_east'])
+        proj.ny = len(nc.dimensions['south_north'])
+        if ('bottom_top' in nc.dimensions):
+            proj.nz = len(nc.dimensions['bottom_top'])
+        proj.dx = float(nc.DX)
+        proj.dy = float(nc.DY)
+        proj.cenlat = float(nc.CEN_LAT)
+        proj.cenlon = float(nc.CEN_LON)
+        proj.stdlat1 = float(nc.TRUELAT1)
+        proj.stdlat2 = float(nc.TRUELAT2)
+        proj.stdlon = float(nc.STAND_LON)
+
+        if 'XLAT' in nc.variables:
+            proj.xlat = _np.squeeze(nc.variables["XLAT"][:])
+            tmp = _np.squeeze(nc.variables["XLONG"][:])
+            proj.xlon = (tmp < 0.0) * 360.0 + tmp
+        elif 'XLAT_M' in nc.variables:
+            proj.xlat = _np.squeeze(nc.variables["XLAT_M"][:])
+            tmp = _np.squeeze(nc.variables["XLONG_M"][:])
+            proj.xlon = (tmp < 0.0) * 360.0 + tmp
+
+        proj.lat1 = proj.xlat[0, 0]
+        proj.lon1 = proj.xlon[0, 0]
 
     if (proj.code == 1):
         proj.projection = 'lcc'
@@ -10,5 +10,6 @@ import pyarsenal.GFS
 import pyarsenal.GSI
 import pyarsenal.WRF
 import pyarsenal.meteor
+import pyarsenal.FortranIO
 
 #import pyarsenal.GrADS
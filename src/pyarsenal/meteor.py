@@ -5,9 +5,206 @@ meteor.py contains commonly used meteorological related functions
 At some point, one should start using Unidata MetPy module instead
 '''
 
+import functools as _functools
+import os as _os
 import numpy as _np
+from concurrent.futures import ThreadPoolExecutor as _ThreadPoolExecutor
+from scipy.spatial import cKDTree as _cKDTree
 
-__all__ = ['atmos_const', 'meteor']
+try:
+    import numba as _numba
+except ImportError:
+    _numba = None
+
+__all__ = ['atmos_const', 'meteor', 'earth_index']
+
+
+def _scalar(out):
+    ''' return 0-d results as scalars, as numpy ufuncs do '''
+    return out[()] if (out.ndim == 0) else out
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    '''
+    central angle (radians) between points given in radians; the haversine
+    form stays accurate at short range, where arccos of the cosine loses
+    half of the significant digits
+    '''
+
+    hav = _np.sin(0.5 * (lat2 - lat1))**2 + \
+        _np.cos(lat1) * _np.cos(lat2) * _np.sin(0.5 * (lon2 - lon1))**2
+    return 2.0 * _np.arcsin(_np.sqrt(_np.clip(hav, 0.0, 1.0)))
+
+
+def _unit_vectors(lat, lon):
+    ''' (n, 3) unit vectors of points given in degrees '''
+
+    lat = _np.radians(_np.asarray(lat, dtype=_np.float64)).ravel()
+    lon = _np.radians(_np.asarray(lon, dtype=_np.float64)).ravel()
+    coslat = _np.cos(lat)
+    return _np.stack([coslat * _np.cos(lon), coslat * _np.sin(lon), _np.sin(lat)], axis=-1)
+
+
+def _collapse(shape, cshape, axis):
+    '''
+    Shape (cpre, n, cpost) of a coordinate that broadcasts against a field of
+    shape, collapsed around axis so that element (p, i, q) of the field
+    viewed as (pre, n, post) pairs with coordinate (p % cpre, i, q % cpost).
+    That holds when the coordinate dimensions on either side of axis are
+    ones followed by the matching trailing field dimensions; None otherwise.
+    '''
+
+    cshape = (1,) * (len(shape) - len(cshape)) + tuple(cshape)
+    if (cshape[axis] != shape[axis]):
+        return None
+    sizes = []
+    for (dims, cdims) in [(shape[:axis], cshape[:axis]), (shape[axis + 1:], cshape[axis + 1:])]:
+        k = len(cdims)
+        while (k > 0 and cdims[k - 1] == dims[k - 1]):
+            k -= 1
+        if (any(d != 1 for d in cdims[:k])):
+            return None
+        sizes.append(int(_np.prod(cdims[k:])))
+    return (sizes[0], shape[axis], sizes[1])
+
+
+@_functools.lru_cache(maxsize=None)
+def _esat_table(eo, LoRv, Tfrez, tmin, tmax, rtol):
+    '''
+    Tabulate the Clausius-Clapeyron saturation vapor pressure between
+    tmin and tmax on a uniform grid fine enough that linear interpolation
+    is within a relative error rtol of it; the bound is checked at the
+    midpoints of the table, where the error of linear interpolation of
+    a convex function peaks, and the grid refined until it holds.
+    Returns (table, differences, tmin, step, achieved relative error)
+    '''
+
+    def esat(t):
+        return eo * _np.exp(LoRv * (1.0 / Tfrez - 1.0 / t))
+
+    # h**2 / 8 * max|f''/f| with f''/f = (a/T**2)**2 - 2a/T**3, largest at tmin
+    curv = (LoRv / tmin**2)**2 - 2.0 * LoRv / tmin**3
+    npts = int(_np.ceil((tmax - tmin) / _np.sqrt(8.0 * rtol / curv))) + 1
+    while True:
+        temp = _np.linspace(tmin, tmax, npts)
+        table = esat(temp)
+        mid = 0.5 * (temp[1:] + temp[:-1])
+        error = _np.max(_np.abs(0.5 * (table[1:] + table[:-1]) / esat(mid) - 1.0))
+        if (error <= rtol):
+            break
+        npts = 2 * npts - 1
+    return (table, _np.diff(table), tmin, temp[1] - temp[0], error)
+
+
+@_functools.lru_cache(maxsize=None)
+def _numba_kernels():
+    '''
+    Compile the numba kernels on first use, so importing meteor stays cheap.
+    Fields are viewed as (pre, n, post) around the differentiated axis and
+    coordinates as collapsed by _collapse; a uniform spacing is passed as the
+    one- and two-step denominators (dx1, dx2) instead.
+    '''
+
+    njit = _numba.njit(parallel=True, fastmath=False)
+
+    @njit
+    def deriv(f, c, uniform, dx1, dx2, out):
+        npre, n, npost = f.shape
+        cpre, cpost = c.shape[0], c.shape[2]
+        for pi in _numba.prange(npre * n):
+            p = pi // n
+            i = pi % n
+            i0 = max(i - 1, 0)
+            i1 = min(i + 1, n - 1)
+            for q in range(npost):
+                if (uniform):
+                    d = dx2 if (i1 - i0 == 2) else dx1
+                else:
+                    d = c[p % cpre, i1, q % cpost] - c[p % cpre, i0, q % cpost]
+                out[p, i, q] = (f[p, i1, q] - f[p, i0, q]) / d
+
+    @njit
+    def advection(u, v, f, cx, xuniform, dx1, dx2, cy, yuniform, dy1, dy2, out):
+        npre, ny, nx = f.shape
+        cxpre = cx.shape[0]
+        cypre, cypost = cy.shape[0], cy.shape[2]
+        for pj in _numba.prange(npre * ny):
+            p = pj // ny
+            j = pj % ny
+            j0 = max(j - 1, 0)
+            j1 = min(j + 1, ny - 1)
+            for i in range(nx):
+                i0 = max(i - 1, 0)
+                i1 = min(i + 1, nx - 1)
+                if (xuniform):
+                    ddx = dx2 if (i1 - i0 == 2) else dx1
+                else:
+                    ddx = cx[pj % cxpre, i1, 0] - cx[pj % cxpre, i0, 0]
+                if (yuniform):
+                    ddy = dy2 if (j1 - j0 == 2) else dy1
+                else:
+                    ddy = cy[p % cypre, j1, i % cypost] - cy[p % cypre, j0, i % cypost]
+                dfdx = (f[p, j, i1] - f[p, j, i0]) / ddx
+                dfdy = (f[p, j1, i] - f[p, j0, i]) / ddy
+                out[p, j, i] = -(u[p, j, i] * dfdx) - (v[p, j, i] * dfdy)
+
+    @njit
+    def esat_table(t, table, dtable, tmin, tmax, rstep, out):
+        # interpolated in float64; returns the number of values outside the
+        # table (or nan), which are left for the caller to evaluate exactly
+        n = dtable.shape[0]
+        nout = 0
+        for i in _numba.prange(t.shape[0]):
+            ti = _np.float64(t[i])
+            if (ti >= tmin and ti <= tmax):
+                x = (ti - tmin) * rstep
+            else:
+                nout += 1
+                x = 0.0
+            k = min(int(x), n - 1)
+            out[i] = table[k] + (x - k) * dtable[k]
+        return nout
+
+    return {'deriv': deriv, 'advection': advection, 'esat_table': esat_table}
+
+
+def _tile(arr, ndim, axis, sl):
+    ''' slice sl along axis of an ndim field out of arr, which broadcasts against it '''
+
+    if (arr is None):
+        return None
+    arr = _np.asanyarray(arr)
+    k = axis - (ndim - arr.ndim)
+    if (k < 0 or arr.shape[k] == 1):
+        return arr
+    return arr[(slice(None),) * k + (sl,)]
+
+
+def _ycoord(y, shape):
+    ''' y as lying along latitude of a field of shape, if it is 1-D along that axis '''
+
+    yc = _np.asanyarray(y)
+    if (yc.ndim == 1 and len(shape) >= 2 and yc.shape[0] == shape[-2]):
+        return yc.reshape((-1, 1))
+    return y
+
+
+def _numba_coord(shape, cin, axis):
+    '''
+    Arguments (c, uniform, d1, d2) describing cin to the numba kernels,
+    or None if the kernels cannot handle it
+    '''
+
+    if (cin.dtype.kind not in 'iuf'):
+        return None
+    cin = _np.asarray(cin, dtype=_np.result_type(cin, 1.0))
+    if (cin.ndim == 0):
+        return (_np.zeros((1, 1, 1), dtype=cin.dtype), True, 1 * cin[()], 2 * cin[()])
+    cshape = _collapse(shape, cin.shape, axis)
+    if (cshape is None):
+        return None
+    zero = cin.dtype.type(0)
+    return (_np.ascontiguousarray(cin).reshape(cshape), False, zero, zero)
 
 
 class atmos_const(object):
@@ -62,25 +259,73 @@ class meteor(object):
     Define a class that contains most commonly used meteorological functions
     '''
 
-    def __init__(self):
+    def __init__(self, backend='numpy', esat='exact', esat_rtol=1.0e-6, esat_range=(150.0, 350.0)):
+        '''
+        backend - 'numpy' (default) or 'numba' to run deriv, ddx, ddy, ddp,
+                  gradient_2d and advection as compiled, fused and parallel
+                  kernels; falls back silently to numpy when numba is not
+                  installed or the inputs are not supported (e.g. coordinates
+                  that broadcast in unusual ways, non-float fields)
+        esat - 'exact' to evaluate Clausius-Clapeyron for every saturation vapor
+               pressure (default), or 'table' to interpolate linearly in a
+               precomputed table; this only pays off with backend='numba',
+               where the lookup is one compiled pass (about twice as fast as
+               numpy's exp for float64, on par for float32); with numpy the
+               gathers are several times slower than exact
+        esat_rtol - relative error bound of the table (default: 1e-6), on top
+                    of the rounding of the data type
+        esat_range - temperatures (K) covered by the table (default: 150 - 350);
+                     values outside it are evaluated exactly
+        The tables are cached and shared by all meteor instances.
+        '''
         self.atmos_const = atmos_const()
+        if backend not in ['numpy', 'numba']:
+            raise ValueError("backend must be 'numpy' or 'numba', not %s" % backend)
+        if esat not in ['exact', 'table']:
+            raise ValueError("esat must be 'exact' or 'table', not %s" % esat)
+        self.backend = backend
+        self.esat = esat
+        self.esat_rtol = esat_rtol
+        self.esat_range = tuple(esat_range)
         return
 
-    def altimeter(self, pin, hin):
+    def _numba(self):
+        ''' numba kernels if the numba backend is selected and available '''
+
+        if (self.backend != 'numba' or _numba is None):
+            return None
+        return _numba_kernels()
+
+    def _out(self, out, *args):
+        ''' output array for the broadcast of args, float32 if they all are '''
+
+        if (out is None):
+            out = _np.empty(_np.broadcast(*args).shape,
+                            dtype=_np.result_type(*args, 1.0))
+        return out
+
+    def altimeter(self, pin, hin, out=None):
         ''' altimeter given pressure and altitude '''
 
-        pexp = (self.atmos_const.Rd * self.atmos_const.lapseta) / \
+        pexp = (self.atmos_const.Rd * self.atmos_const.lapsesta) / \
             self.atmos_const.g
         invpexp = 1.0 / pexp
-        alt = pin * (1.0 + ((self.atmos_const.Po / pin) ** pexp) *
-                     (self.atmos_const.lapsesta * hin / self.atmos_const.Talt)) ** invpexp
-
-        return alt
+        # alt = pin * (1 + (Po / pin)**pexp * (lapsesta * hin / Talt))**invpexp
+        alt = self._out(out, pin, hin)
+        _np.divide(self.atmos_const.Po, pin, out=alt)
+        _np.power(alt, pexp, out=alt)
+        alt *= hin
+        alt *= self.atmos_const.lapsesta / self.atmos_const.Talt
+        alt += 1.0
+        _np.power(alt, invpexp, out=alt)
+        alt *= pin
+
+        return _scalar(alt)
 
     def alt_to_psfc(self, alt, hin):
         ''' reduce the altitude to surface pressure '''
 
-        pexp = (self.atmos_const.Rd * self.atmos_const.lapseta) / \
+        pexp = (self.atmos_const.Rd * self.atmos_const.lapsesta) / \
             self.atmos_const.g
         invpexp = 1.0 / pexp
         psfc = (alt ** pexp -
@@ -91,71 +336,313 @@ class meteor(object):
 
         return psfc
 
-    def clausius_clapeyron(self, tin):
+    def clausius_clapeyron(self, tin, out=None):
         ''' saturated vapor pressure or Clausius-Clapeyron '''
 
-        esat = self.atmos_const.eo * \
-            _np.exp((self.atmos_const.L / self.atmos_const.Rv)
-                    * (1.0 / self.atmos_const.Tfrez - 1.0 / tin))
+        # esat = eo * exp((L / Rv) * (1 / Tfrez - 1 / tin))
+        esat = self._out(out, tin)
+        _np.divide(-1.0, tin, out=esat)
+        esat += 1.0 / self.atmos_const.Tfrez
+        esat *= self.atmos_const.L / self.atmos_const.Rv
+        _np.exp(esat, out=esat)
+        esat *= self.atmos_const.eo
 
-        return esat
+        return _scalar(esat)
 
-    def sat_vapor_pressure(self, tin):
-        ''' saturated vapor pressure '''
+    def sat_vapor_pressure(self, tin, out=None):
+        ''' saturated vapor pressure, from a table if self.esat == 'table' '''
 
-        esat = self.clausius_clapeyron(tin)
+        if (self.esat == 'table'):
+            esat = self.esat_lookup(tin, out=out)
+        else:
+            esat = self.clausius_clapeyron(tin, out=out)
 
         return esat
 
-    def sat_mixrat(self, es, pin):
+    def esat_lookup(self, tin, out=None):
+        '''
+        saturated vapor pressure interpolated linearly in a table of
+        Clausius-Clapeyron, within a relative error self.esat_rtol of it
+        in self.esat_range, and exact outside it; the interpolation is done
+        in float64, so float32 results only add their own rounding
+        '''
+
+        tmin, tmax = (float(t) for t in self.esat_range)
+        table, dtable, tmin, step, _ = _esat_table(self.atmos_const.eo,
+                                                   self.atmos_const.L / self.atmos_const.Rv,
+                                                   self.atmos_const.Tfrez,
+                                                   tmin, tmax, float(self.esat_rtol))
+
+        esat = self._out(out, tin)
+        tin = _np.broadcast_to(tin, esat.shape)
+        kernels = self._numba()
+        if (kernels is not None and tin.dtype.kind in 'iuf' and esat.dtype.kind == 'f'):
+            res = esat if (esat.flags.c_contiguous) else _np.empty(esat.shape, dtype=esat.dtype)
+            nout = kernels['esat_table'](_np.ascontiguousarray(tin).reshape(-1), table, dtable,
+                                         tmin, tmax, 1.0 / step, res.reshape(-1))
+            if (res is not esat):
+                esat[...] = res
+        else:
+            # fractional index into the table
+            x = tin.astype(_np.float64)
+            x -= tmin
+            x /= step
+            # fmax and fmin also send nan to the table; it is evaluated exactly below
+            _np.fmax(x, 0, out=x)
+            _np.fmin(x, len(dtable), out=x)
+            ind = x.astype(_np.intp)
+            _np.minimum(ind, len(dtable) - 1, out=ind)
+            x -= ind
+            x *= dtable.take(ind)
+            x += table.take(ind)
+            esat[...] = x
+            nout = 1
+
+        if (nout > 0):
+            t64 = tin.astype(_np.float64)
+            outside = ~((t64 >= tmin) & (t64 <= tmax))
+            if outside.any():
+                esat[outside] = self.clausius_clapeyron(tin[outside])
+
+        return _scalar(esat)
+
+    def sat_mixrat(self, es, pin, out=None):
         ''' saturated mixing ratio '''
 
-        ws = 0.622 * (es / (pin - es))
+        # ws = 0.622 * (es / (pin - es))
+        ws = self._out(out, es, pin)
+        _np.subtract(pin, es, out=ws)
+        _np.divide(es, ws, out=ws)
+        ws *= 0.622
 
-        return ws
+        return _scalar(ws)
 
-    def mixrat_to_tdew(self, qvap, pres):
-        ''' mixing ratio to dew-point temperature '''
+    def mixrat_to_tdew(self, qvap, pres, out=None):
+        ''' mixing ratio to dew-point temperature (0 K where qvap == 0, nan where qvap < 0) '''
 
-        evap = qvap * pres * self.atmos_const.Rv / self.atmos_const.Rd
-        tdew = 1.0 / ((1.0 / self.atmos_const.Tfrez) - (self.atmos_const.Rv /
-                                                        self.atmos_const.L) * _np.emath.log(evap / self.atmos_const.eo))
+        # evap = qvap * pres * Rv / Rd
+        # tdew = 1 / (1 / Tfrez - (Rv / L) * log(evap / eo))
+        tdew = self._out(out, qvap, pres)
+        _np.multiply(qvap, pres, out=tdew)
+        tdew *= self.atmos_const.Rv / (self.atmos_const.Rd * self.atmos_const.eo)
+        _np.log(tdew, out=tdew)
+        tdew *= -self.atmos_const.Rv / self.atmos_const.L
+        tdew += 1.0 / self.atmos_const.Tfrez
+        _np.reciprocal(tdew, out=tdew)
 
-        return tdew
+        return _scalar(tdew)
 
-    def dry_static_energy(self, tin, zin):
+    def dry_static_energy(self, tin, zin, out=None):
         ''' dry static energy '''
 
-        dse = self.atmos_const.Cp * tin + self.atmos_const.g * zin
+        # dse = Cp * tin + g * zin
+        dse = self._out(out, tin, zin)
+        _np.multiply(zin, self.atmos_const.g / self.atmos_const.Cp, out=dse)
+        dse += tin
+        dse *= self.atmos_const.Cp
 
-        return dse
+        return _scalar(dse)
 
-    def moist_static_energy(self, tin, zin, qin):
+    def moist_static_energy(self, tin, zin, qin, out=None):
         ''' moist static energy '''
 
-        mse = self.dry_static_energy(tin, zin) + self.atmos_const.L * qin
-
-        return mse
+        # mse = Cp * tin + g * zin + L * qin
+        mse = self.dry_static_energy(tin, zin, out=self._out(out, tin, zin, qin))
+        mse /= self.atmos_const.L
+        mse += qin
+        mse *= self.atmos_const.L
+
+        return _scalar(mse)
+
+    def diagnose(self, names, blocksize=16384, out=None, **fields):
+        '''
+        Evaluate several thermodynamic diagnostics together, a cache-sized
+        block at a time, so that no field-sized temporaries are made
+
+        esat, tdew = meteor().diagnose(['esat', 'tdew'], tin=t, pin=p, qin=q)
+
+            names - diagnostics to compute, any of
+                    'esat' (tin), 'wsat' (tin, pin), 'tdew' (qin, pin),
+                    'dse' (tin, zin), 'mse' (tin, zin, qin), 'altimeter' (pin, hin)
+        blocksize - number of grid points per block (default: 16384)
+              out - optional list of output arrays, one per name (None to allocate)
+           fields - the input fields named above; they are broadcast together
+        Returns a tuple of the diagnostics, float32 if the inputs all are
+        '''
+
+        need = {'esat': ['tin'], 'wsat': ['tin', 'pin'], 'tdew': ['qin', 'pin'],
+                'dse': ['tin', 'zin'], 'mse': ['tin', 'zin', 'qin'],
+                'altimeter': ['pin', 'hin']}
+        for name in names:
+            if name not in need:
+                raise ValueError('diagnose: unknown diagnostic, %s' % name)
+        inputs = sorted(set(sum([need[name] for name in names], [])))
+        for field in inputs:
+            if field not in fields:
+                raise ValueError('diagnose: missing input field, %s' % field)
+        if (out is None):
+            out = [None] * len(names)
+
+        ops = [fields[field] for field in inputs]
+        dtype = _np.result_type(*ops, 1.0)
+        nin = len(ops)
+        it = _np.nditer(ops + list(out),
+                        flags=['external_loop', 'buffered', 'zerosize_ok'],
+                        op_flags=[['readonly']] * nin + [['writeonly', 'allocate']] * len(names),
+                        op_dtypes=[dtype] * (nin + len(names)),
+                        casting='same_kind', buffersize=blocksize)
+        with it:
+            scratch = _np.empty(blocksize, dtype=dtype)
+            for block in it:
+                b = dict(zip(inputs, block[:nin]))
+                res = dict(zip(names, block[nin:]))
+                # esat first, as wsat reuses it
+                for name in sorted(names, key=lambda name: name != 'esat'):
+                    o = res[name]
+                    if (name == 'esat'):
+                        self.sat_vapor_pressure(b['tin'], out=o)
+                    elif (name == 'wsat'):
+                        es = res['esat'] if ('esat' in res) else \
+                            self.sat_vapor_pressure(b['tin'], out=scratch[:len(o)])
+                        self.sat_mixrat(es, b['pin'], out=o)
+                    elif (name == 'tdew'):
+                        self.mixrat_to_tdew(b['qin'], b['pin'], out=o)
+                    elif (name == 'dse'):
+                        self.dry_static_energy(b['tin'], b['zin'], out=o)
+                    elif (name == 'mse'):
+                        self.moist_static_energy(b['tin'], b['zin'], b['qin'], out=o)
+                    elif (name == 'altimeter'):
+                        self.altimeter(b['pin'], b['hin'], out=o)
+            result = tuple(it.operands[nin:])
+
+        return result
 
     def earth_dist(self, xlat1, xlon1, xlat2, xlon2):
-        ''' distance between two points on a sphere (Earth) '''
+        '''
+        distance between two points on a sphere (Earth)
+        haversine formula, element by element with broadcasting (degrees in, m out)
+        '''
 
         pid = _np.pi / 180.0
-        e_dist = self.atmos_const.R_earth * _np.arccos(_np.sin(xlat1 * pid) * _np.sin(
-            xlat2 * pid) + _np.cos(xlat1 * pid) * _np.cos(xlat2 * pid) * _np.cos((xlon2 - xlon1) * pid))
+        angle = _haversine(_np.multiply(xlat1, pid), _np.multiply(xlon1, pid),
+                           _np.multiply(xlat2, pid), _np.multiply(xlon2, pid))
+        e_dist = self.atmos_const.R_earth * angle
 
         return e_dist
 
-    def advection(self, uwnd, vwnd, fld, dx, dy, mfac=None):
-        ''' simple advection of a field '''
+    def earth_dist_matrix(self, xlat1, xlon1, xlat2, xlon2, blocksize=None, out=None):
+        '''
+        distances between all pairs of two sets of points on a sphere (Earth)
+
+        xlat1, xlon1 - first set of points (degrees), flattened to n points
+        xlat2, xlon2 - second set of points (degrees), flattened to m points
+           blocksize - number of rows (points of the first set) per block
+                       (default: 2**20 // m, about a million pairs)
+                 out - optional (n, m) output array, e.g. a np.memmap for
+                       matrices larger than memory
+        Returns the (n, m) matrix of great-circle distances (m).
+        Use earth_index instead when only near neighbours are of interest.
+        '''
+
+        pid = _np.pi / 180.0
+        lat1 = _np.ravel(xlat1) * pid
+        lon1 = _np.ravel(xlon1) * pid
+        lat2 = _np.ravel(xlat2) * pid
+        lon2 = _np.ravel(xlon2) * pid
+        (n, m) = (lat1.size, lat2.size)
+        if (out is None):
+            out = _np.empty((n, m))
+        elif (out.shape != (n, m)):
+            raise ValueError('out has shape %s, expected %s' % (out.shape, (n, m)))
+        if (blocksize is None):
+            blocksize = max(1, 2**20 // max(m, 1))
+
+        coslat2 = _np.cos(lat2)
+        for i0 in range(0, n, blocksize):
+            i1 = min(i0 + blocksize, n)
+            hav = _np.sin(0.5 * (lat2 - lat1[i0:i1, None]))**2
+            hav += (_np.cos(lat1[i0:i1, None]) * coslat2) * _np.sin(0.5 * (lon2 - lon1[i0:i1, None]))**2
+            _np.clip(hav, 0.0, 1.0, out=hav)
+            _np.sqrt(hav, out=hav)
+            _np.arcsin(hav, out=hav)
+            _np.multiply(hav, 2.0 * self.atmos_const.R_earth, out=out[i0:i1])
+
+        return out
+
+    def advection(self, uwnd, vwnd, fld, dx, dy, mfac=None, workers=1):
+        '''
+        simple advection of a field
+        workers - number of threads to split the field across (default: 1;
+                  None for all cores), see _tiled
+        '''
+
+        # a 1-D dy is along latitude, before any map factor is applied
+        dy = _ycoord(dy, _np.shape(fld))
+        if (workers != 1):
+            return self._tiled(self.advection, workers, fld, uwnd=uwnd, vwnd=vwnd,
+                               fld=fld, dx=dx, dy=dy, mfac=mfac)
+
+        kernels = self._numba()
+        if (kernels is not None):
+            adv = self._advection_numba(kernels, uwnd, vwnd, fld, dx, dy, mfac)
+            if (adv is not None):
+                return adv
 
         dfdx, dfdy = self.gradient_2d(fld, dx, dy, mfac=mfac)
         adv = -(uwnd * dfdx) - (vwnd * dfdy)
 
         return adv
 
-    def gradient_2d(self, indat, x, y, mfac=None):
-        ''' horizontal gradient of a field '''
+    def _advection_numba(self, kernels, uwnd, vwnd, fld, dx, dy, mfac):
+        ''' fused advection kernel; None if the inputs are not supported '''
+
+        fld = _np.asarray(fld)
+        if (fld.ndim < 2 or fld.dtype.kind != 'f' or min(fld.shape[-2:]) < 2):
+            return None
+        if (mfac is not None):
+            dx = dx / mfac
+            dy = dy / mfac
+        # a 1-D dx is along its own axis, as in deriv; advection has made dy a column
+        xc = _np.asanyarray(dx)
+        yc = _np.asanyarray(dy)
+        xarg = _numba_coord(fld.shape, xc, fld.ndim - 1)
+        yarg = _numba_coord(fld.shape, yc, fld.ndim - 2)
+        # the winds as given, so that python floats keep float32
+        wnd = (uwnd, vwnd)
+        uwnd = _np.asarray(uwnd)
+        vwnd = _np.asarray(vwnd)
+        if (xarg is None or yarg is None or uwnd.dtype.kind not in 'iuf' or vwnd.dtype.kind not in 'iuf'):
+            return None
+        try:
+            shape = _np.broadcast(uwnd, vwnd, fld).shape
+        except ValueError:
+            return None
+        if (shape != fld.shape):
+            return None
+
+        view = (-1,) + fld.shape[-2:]
+        f = _np.ascontiguousarray(fld).reshape(view)
+        u = _np.ascontiguousarray(_np.broadcast_to(uwnd, shape)).reshape(view)
+        v = _np.ascontiguousarray(_np.broadcast_to(vwnd, shape)).reshape(view)
+        # as in the numpy path: the gradient has the type of fld and the
+        # coordinates, the advection that of the gradient and the winds
+        gtype = _np.result_type(fld, dx, dy, 1.0)
+        out = _np.empty(fld.shape, dtype=_np.result_type(gtype, wnd[0], wnd[1]))
+        kernels['advection'](u, v, f, *xarg, *yarg, out.reshape(view))
+        return out
+
+    def gradient_2d(self, indat, x, y, mfac=None, workers=1):
+        '''
+        horizontal gradient of a field
+        workers - number of threads to split the field across (default: 1;
+                  None for all cores), see _tiled
+        '''
+
+        # a 1-D y is along latitude, before any map factor is applied
+        y = _ycoord(y, _np.shape(indat))
+        if (workers != 1):
+            return self._tiled(self.gradient_2d, workers, indat, indat=indat,
+                               x=x, y=y, mfac=mfac)
 
         if (mfac is None):
             gradx = self.ddx(indat, x)
@@ -166,49 +653,236 @@ class meteor(object):
 
         return (gradx, grady)
 
-    def ddx(self, fldin, xin):
-        ''' d(field) / dx '''
-
-        iy, ix = _np.shape(fldin)
-        xpt = _np.arange(1, ix - 1)
-        fldout = _np.zeros((iy, ix))
-
-        fldout[:, xpt] = (fldin[:, xpt + 1] - fldin[:, xpt - 1]) / \
-            (xin[:, xpt + 1] - xin[:, xpt - 1])
-        fldout[:,  0] = (fldin[:,    1] - fldin[:,    0]) / \
-            (xin[:, 1] - xin[:, 0])
-        fldout[:, -1] = (fldin[:,   -1] - fldin[:,   -2]) / \
-            (xin[:, -1] - xin[:, -2])
-
-        return fldout
-
-    def ddy(self, fldin, yin):
-        ''' d(field) / dy '''
-
-        iy, ix = _np.shape(fldin)
-        ypt = _np.arange(1, iy - 1)
-        fldout = _np.zeros((iy, ix))
-
-        fldout[ypt, :] = (fldin[ypt + 1, :] - fldin[ypt - 1, :]
-                          ) / (yin[ypt + 1, :] - yin[ypt - 1, :])
-        fldout[0, :] = (fldin[1, :] - fldin[0, :]) / (yin[1, :] - yin[0, :])
-        fldout[-1, :] = (fldin[-1, :] - fldin[-2, :]) / \
-            (yin[-1, :] - yin[-2, :])
-
-        return fldout
-
-    def ddp(self, fldin, presin):
-        ''' d(field) / dpressure '''
-
-        iz, iy, ix = _np.shape(fldin)
-        zpt = _np.arange(1, iz - 1)
-        fldout = _np.zeros((iz, iy, ix))
+    def _tiled(self, func, workers, field, **args):
+        '''
+        Run the horizontal operator func(**args, workers=1) on tiles of the
+        field in a thread pool; numpy releases the GIL in the arithmetic, so
+        the tiles run concurrently. field is the field argument of func, the
+        other args are arrays that broadcast against it.
+        Tiles are cut along the longest leading (time, level) axis, which
+        the operators do not differentiate along; when that is shorter than
+        the latitude axis, e.g. for 2-D fields, they are cut along latitude
+        with a one row halo on each side, so every tile edge gets the same
+        centered difference as in a single pass, and the halo rows are
+        dropped. Each element is evaluated by the same operations as in the
+        serial path, so the results are bit-for-bit identical to it.
+        With backend='numba' the kernels are already parallel and func runs
+        once on the whole field.
+        '''
+
+        fld = _np.asanyarray(field)
+        if (workers is None):
+            workers = _os.cpu_count() or 1
+        if (fld.ndim < 2 or workers <= 1 or self._numba() is not None):
+            return func(workers=1, **args)
+        if (_np.broadcast(*[a for a in args.values() if (a is not None)]).shape != fld.shape):
+            return func(workers=1, **args)
+
+        lead = max(range(fld.ndim - 2), key=lambda k: fld.shape[k], default=None)
+        if (lead is not None and fld.shape[lead] >= min(workers, fld.shape[-2])):
+            (axis, halo) = (lead, 0)
+        else:
+            (axis, halo) = (fld.ndim - 2, 1)
+        n = fld.shape[axis]
+        ntiles = min(workers, n)
+        bounds = [(n * k) // ntiles for k in range(ntiles + 1)]
+
+        def run(a, b):
+            a0 = max(a - halo, 0)
+            b0 = min(b + halo, n)
+            sl = slice(a0, b0)
+            res = func(workers=1, **dict((k, _tile(v, fld.ndim, axis, sl)) for (k, v) in args.items()))
+            keep = (slice(None),) * axis + (slice(a - a0, b - a0),)
+            return tuple(r[keep] for r in res) if (isinstance(res, tuple)) else res[keep]
+
+        with _ThreadPoolExecutor(ntiles) as pool:
+            tiles = list(pool.map(run, bounds[:-1], bounds[1:]))
+
+        first = tiles[0] if (isinstance(tiles[0], tuple)) else (tiles[0],)
+        outs = tuple(_np.empty(fld.shape, dtype=r.dtype) for r in first)
+        for (a, b, res) in zip(bounds[:-1], bounds[1:], tiles):
+            index = (slice(None),) * axis + (slice(a, b),)
+            for (o, r) in zip(outs, res if (isinstance(res, tuple)) else (res,)):
+                o[index] = r
+        return outs if (isinstance(tiles[0], tuple)) else outs[0]
+
+    def deriv(self, fldin, cin, axis=-1, out=None):
+        '''
+        d(field) / d(coordinate) along any axis of an N-D field
+        centered differences in the interior, one-sided differences at the edges
+
+        fldin - field, e.g. (time, level, lat, lon)
+          cin - coordinate: a scalar grid spacing, a 1-D array along axis,
+                or an array that broadcasts against fldin (e.g. (lat, lon))
+         axis - axis to differentiate along (default: -1)
+          out - optional output array (must not overlap fldin)
+        The operands are basic slices of fldin and cin, so no field-sized
+        temporaries are made; float32 input gives float32 output.
+        '''
+
+        fldin = _np.asanyarray(fldin)
+        # from the coordinate as given, so that a python float spacing keeps float32
+        dtype = _np.result_type(fldin, cin, 1.0)
+        cin = _np.asanyarray(cin)
+        axis = axis % fldin.ndim
+        if (fldin.shape[axis] < 2):
+            raise ValueError('need at least 2 points along axis %d to differentiate' % axis)
+        if (cin.ndim == 1 and cin.shape[0] == fldin.shape[axis]):
+            cin = cin.reshape((-1,) + (1,) * (fldin.ndim - 1 - axis))
+        caxis = axis - (fldin.ndim - cin.ndim)
+        if (cin.ndim > 0 and caxis < 0):
+            raise ValueError('coordinate of shape %s does not vary along axis %d' % (cin.shape, axis))
+
+        if (out is None):
+            out = _np.empty(fldin.shape, dtype=dtype)
+
+        kernels = self._numba()
+        if (kernels is not None and fldin.dtype.kind == 'f' and out.dtype.kind == 'f'):
+            carg = _numba_coord(fldin.shape, cin, axis)
+            if (carg is not None):
+                view = (int(_np.prod(fldin.shape[:axis])), fldin.shape[axis], int(_np.prod(fldin.shape[axis + 1:])))
+                res = out if (out.flags.c_contiguous) else _np.empty(out.shape, dtype=out.dtype)
+                kernels['deriv'](_np.ascontiguousarray(fldin).reshape(view), *carg, res.reshape(view))
+                if (res is not out):
+                    out[...] = res
+                return out
+
+        idx = (slice(None),) * axis
+        cidx = (slice(None),) * caxis
+        # (output, upper and lower operands, number of grid steps between them)
+        for (o, s1, s0, nsteps) in [(slice(1, -1), slice(2, None), slice(None, -2), 2),
+                                    (slice(None, 1), slice(1, 2), slice(None, 1), 1),
+                                    (slice(-1, None), slice(-1, None), slice(-2, -1), 1)]:
+            res = out[idx + (o,)]
+            _np.subtract(fldin[idx + (s1,)], fldin[idx + (s0,)], out=res)
+            if (cin.ndim == 0):
+                res /= nsteps * cin
+            else:
+                res /= cin[cidx + (s1,)] - cin[cidx + (s0,)]
+
+        return out
+
+    def ddx(self, fldin, xin, out=None):
+        ''' d(field) / dx along the last axis '''
+
+        return self.deriv(fldin, xin, axis=-1, out=out)
+
+    def ddy(self, fldin, yin, out=None):
+        ''' d(field) / dy along the second to last axis '''
+
+        return self.deriv(fldin, yin, axis=-2, out=out)
+
+    def ddp(self, fldin, presin, out=None):
+        ''' d(field) / dpressure along the third to last axis '''
+
+        return self.deriv(fldin, presin, axis=-3, out=out)
+
+
+def _tree_workers(workers):
+    ''' keyword for threaded cKDTree queries; only given when threaded, as it needs scipy 1.6 '''
+
+    return {} if (workers == 1) else {'workers': workers}
+
+
+class earth_index(object):
+    '''
+    Nearest-neighbour index of points on a sphere (Earth), e.g. grid points
+    or observations, for matching other points against them.
+    The points are held as 3-D unit vectors in a KD-tree, where the chord
+    between two points grows monotonically with their great-circle distance;
+    the distances returned are recomputed with the haversine formula.
+    '''
 
-        fldout[zpt, :, :] = (fldin[zpt + 1, :, :] - fldin[zpt - 1, :, :]) / \
-            (presin[zpt + 1, :, :] - presin[zpt - 1, :, :])
-        fldout[0, :, :] = (fldin[1, :, :] - fldin[0, :, :]) / \
-            (presin[1, :, :] - presin[0, :, :])
-        fldout[-1, :, :] = (fldin[-1, :, :] - fldin[-2, :, :]) / \
-            (presin[-1, :, :] - presin[-2, :, :])
+    def __init__(self, xlat, xlon, radius=None, leafsize=16):
+        '''
+        xlat, xlon - points (degrees), any matching shape; results index
+                     them as flattened
+            radius - radius of the sphere (default: Earth radius, m)
+          leafsize - leaf size of the KD-tree
+        '''
+
+        (xlat, xlon) = _np.broadcast_arrays(_np.asarray(xlat, dtype=_np.float64),
+                                            _np.asarray(xlon, dtype=_np.float64))
+        self.shape = xlat.shape
+        self.radius = atmos_const().R_earth if (radius is None) else radius
+        self._lat = _np.radians(xlat.ravel())
+        self._lon = _np.radians(xlon.ravel())
+        self._tree = _cKDTree(_unit_vectors(xlat, xlon), leafsize=leafsize)
+        return
 
-        return fldout
+    def __len__(self):
+        return self._lat.size
+
+    def _chord(self, dist):
+        ''' chord length on the unit sphere of a great-circle distance '''
+
+        return 2.0 * _np.sin(0.5 * _np.minimum(_np.divide(dist, self.radius), _np.pi))
+
+    def _dist(self, lat, lon, index):
+        ''' great-circle distances to the indexed points; inf where index is len(self) '''
+
+        valid = index < len(self)
+        dist = _np.full(index.shape, _np.inf)
+        ind = index[valid]
+        dist[valid] = _haversine(_np.broadcast_to(lat, index.shape)[valid], _np.broadcast_to(lon, index.shape)[valid],
+                                 self._lat[ind], self._lon[ind]) * self.radius
+        return dist
+
+    def query(self, xlat, xlon, k=1, max_dist=_np.inf, workers=1):
+        '''
+        k nearest indexed points of each query point
+
+        xlat, xlon - query points (degrees), any matching shape
+                 k - number of neighbours
+          max_dist - ignore points further than this (m)
+           workers - threads for the tree search (-1 for all cores;
+                     other than 1 needs scipy 1.6)
+        Returns (dist, index) of shape xlat.shape (+ (k,) if k > 1), nearest
+        first: distances (m) and indices into the flattened points; missing
+        neighbours have distance inf and index len(self), as in cKDTree.
+        '''
+
+        (xlat, xlon) = _np.broadcast_arrays(_np.asarray(xlat, dtype=_np.float64),
+                                            _np.asarray(xlon, dtype=_np.float64))
+        bound = self._chord(max_dist) if (_np.isfinite(max_dist)) else _np.inf
+        (chord, index) = self._tree.query(_unit_vectors(xlat, xlon), k=k,
+                                          distance_upper_bound=bound, **_tree_workers(workers))
+        shape = xlat.shape + ((k,) if (k > 1) else ())
+        index = index.reshape(shape)
+        ext = (Ellipsis, None) if (k > 1) else (Ellipsis,)
+        dist = self._dist(_np.radians(xlat)[ext], _np.radians(xlon)[ext], index)
+
+        return (dist, index)
+
+    def query_radius(self, xlat, xlon, max_dist, workers=1, return_dist=False):
+        '''
+        indexed points within a distance of each query point
+
+        xlat, xlon - query points (degrees), any matching shape
+          max_dist - search radius (m)
+           workers - threads for the tree search (-1 for all cores;
+                     other than 1 needs scipy 1.6)
+       return_dist - also return the distances
+        Returns an object array of shape xlat.shape holding an array of
+        indices into the flattened points for each query point, sorted by
+        index (and a matching array of distance arrays, m, if return_dist).
+        '''
+
+        (xlat, xlon) = _np.broadcast_arrays(_np.asarray(xlat, dtype=_np.float64),
+                                            _np.asarray(xlon, dtype=_np.float64))
+        found = self._tree.query_ball_point(_unit_vectors(xlat, xlon), self._chord(max_dist),
+                                            return_sorted=True, **_tree_workers(workers))
+        index = _np.empty(found.shape, dtype=object)
+        for i, f in enumerate(found):
+            index[i] = _np.asarray(f, dtype=_np.intp)
+        index = index.reshape(xlat.shape)
+        if (not return_dist):
+            return index
+
+        lat = _np.radians(xlat).ravel()
+        lon = _np.radians(xlon).ravel()
+        dist = _np.empty(index.size, dtype=object)
+        for i, ind in enumerate(index.ravel()):
+            dist[i] = _haversine(lat[i], lon[i], self._lat[ind], self._lon[ind]) * self.radius
+
+        return (index, dist.reshape(xlat.shape))
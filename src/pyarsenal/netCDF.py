@@ -2,64 +2,280 @@
 
 '''
 netCDF.py contains utility functions for netCDF files
+
+Files are read through a process-wide pool of open netCDF4.Dataset
+handles, keyed by path and modification time, so that reading several
+variables from the same file opens it only once:
+    pooled_dataset(fname) - context manager lending the handle of a file
+    close_datasets(fname=None) - close pooled handles (of fname, or all)
+    set_pool_size(maxsize) - number of handles kept open (LRU eviction)
+HDF5 does not let a process write a file it holds open, so call
+close_datasets(fname) before rewriting a file that was read.
 '''
 
-__all__ = ['variable_exist', 'read_netCDF_var']
+__all__ = ['variable_exist', 'read_netCDF_var', 'read_netCDF_vars',
+           'pooled_dataset', 'close_datasets', 'set_pool_size']
 
+import atexit as _atexit
+import collections as _collections
+import contextlib as _contextlib
+import os as _os
+import threading as _threading
 import numpy as _np
 from netCDF4 import Dataset as _Dataset
 
 
+class _Handle(object):
+    '''
+    A pooled Dataset: opened lazily by its first user, lent under its lock,
+    which is reentrant so that a thread holding the handle can borrow it again
+    '''
+
+    def __init__(self):
+        self.nc = None
+        self.users = 0
+        self.stale = False
+        self.lock = _threading.RLock()
+
+
+class _DatasetPool(object):
+    '''
+    Thread-safe pool of read-only netCDF4.Dataset handles with least
+    recently used eviction. A handle is lent to one thread at a time, as
+    the netCDF and HDF5 libraries do not allow concurrent use of a file;
+    that thread may borrow it again while holding it (nested use).
+    A file modified since it was opened is opened anew; remote datasets
+    (URLs) are keyed on their URL alone.
+    '''
+
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self._lock = _threading.Lock()
+        # (path, mtime_ns, size) -> entry
+        self._entries = _collections.OrderedDict()
+
+    def _remote(self, fname):
+        ''' whether fname is the URL of a remote (e.g. OPeNDAP) dataset '''
+        return isinstance(fname, str) and '://' in fname
+
+    def _path(self, fname):
+        return fname if (self._remote(fname)) else _os.path.realpath(fname)
+
+    def _key(self, fname):
+        if (self._remote(fname)):
+            # a remote dataset has no modification time or size to check
+            return (fname, None, None)
+        try:
+            st = _os.stat(fname)
+        except OSError:
+            raise IOError('Unable to open %s' % fname)
+        return (self._path(fname), st.st_mtime_ns, st.st_size)
+
+    def _close(self, entry):
+        try:
+            entry.nc.close()
+        except (IOError, RuntimeError):
+            pass
+
+    def _discard(self, entry):
+        ''' close a handle dropped from the pool, or leave it to its last user '''
+        if (entry.users == 0):
+            if (entry.nc is not None):
+                self._close(entry)
+        else:
+            entry.stale = True
+
+    def _evict(self):
+        ''' close the least recently used idle handles beyond maxsize '''
+        for key in list(self._entries):
+            if (len(self._entries) <= self.maxsize):
+                break
+            entry = self._entries[key]
+            if (entry.users == 0):
+                del self._entries[key]
+                self._close(entry)
+
+    @_contextlib.contextmanager
+    def dataset(self, fname):
+        key = self._key(fname)
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is None):
+                # handles of older versions of the file are stale
+                for old in [k for k in self._entries if (k[0] == key[0])]:
+                    self._discard(self._entries.pop(old))
+                entry = _Handle()
+                self._entries[key] = entry
+            self._entries.move_to_end(key)
+            entry.users += 1
+        try:
+            with entry.lock:
+                if (entry.nc is None):
+                    try:
+                        entry.nc = _Dataset(fname, 'r')
+                    except IOError:
+                        raise IOError('Unable to open %s' % fname)
+                yield entry.nc
+        finally:
+            with self._lock:
+                entry.users -= 1
+                if (entry.users == 0):
+                    if (entry.nc is None):
+                        # failed to open; do not keep the entry around
+                        if (self._entries.get(key) is entry):
+                            del self._entries[key]
+                    elif (entry.stale):
+                        self._close(entry)
+                self._evict()
+
+    def close(self, fname=None):
+        path = None if (fname is None) else self._path(fname)
+        with self._lock:
+            for key in list(self._entries):
+                if (path is None or key[0] == path):
+                    self._discard(self._entries.pop(key))
+
+
+_pool = _DatasetPool()
+_atexit.register(_pool.close)
+
+
+def pooled_dataset(fname):
+    '''
+    Context manager lending the pooled, read-only netCDF4.Dataset of fname;
+    the file is opened on first use and stays open for later reads until
+    evicted or closed with close_datasets. Do not close the handle yourself.
+
+    with pooled_dataset(fname) as nc:
+        var = nc.variables[vname][:]
+    '''
+    return _pool.dataset(fname)
+
+
+def close_datasets(fname=None):
+    '''
+    Close the pooled handles of fname, or of all files if fname is None;
+    handles in use are closed when they are released
+    '''
+    _pool.close(fname)
+    return
+
+
+def set_pool_size(maxsize):
+    '''
+    Set the number of netCDF handles kept open (default: 16)
+    '''
+    if (maxsize < 0):
+        raise ValueError('maxsize must be non-negative, not %s' % maxsize)
+    with _pool._lock:
+        _pool.maxsize = maxsize
+        _pool._evict()
+    return
+
+
 def variable_exist(fname, vname, debug=False):
     '''
     Check if a variable in a file exists
     '''
 
-    result = False
+    with pooled_dataset(fname) as nc:
+        result = vname in nc.variables
 
-    try:
-        nc = _Dataset(fname, 'r')
-    except IOError:
-        raise IOError('Unable to open %s' % fname)
+    return result
 
-    if (vname in list(nc.variables.keys())):
-        result = True
 
-    try:
-        nc.close()
-    except IOError:
-        raise IOError('Unable to close %s' % fname)
+def _dim_index(ind):
+    '''
+    index along one dimension as netCDF4 reads it best: evenly spaced
+    index lists and boolean masks become (strided) slices
+    '''
 
-    return result
+    if (ind is None or ind is Ellipsis or isinstance(ind, (slice, int, _np.integer))):
+        return ind
+    ind = _np.asarray(ind)
+    if (ind.dtype == bool):
+        ind = _np.flatnonzero(ind)
+    if (ind.ndim != 1 or ind.dtype.kind not in 'iu'):
+        raise IndexError('index lists must be 1-D integers or booleans')
+    if (ind.size > 1 and _np.all(ind >= 0)):
+        step = ind[1] - ind[0]
+        if (step > 0 and _np.all(_np.diff(ind) == step)):
+            return slice(int(ind[0]), int(ind[-1]) + 1, int(step))
+    return ind
 
 
-def read_netCDF_var(fname, vname, oneD=False, ftime=-1, flevel=-1):
+def _hyperslab(var, index):
+    '''
+    netCDF4 index of var for index: a dict of per-dimension indices keyed
+    by dimension name (missing dimensions are read whole), or a tuple
+    '''
+
+    if (isinstance(index, dict)):
+        index = tuple(index.get(dim, slice(None)) for dim in var.dimensions)
+    elif (not isinstance(index, tuple)):
+        index = (index,)
+    return tuple(_dim_index(ind) for ind in index)
+
+
+def read_netCDF_var(fname, vname, oneD=False, ftime=-1, flevel=-1, index=None, squeeze=True):
     '''
     Read a variable from a netCDF file
+    index - (optional) hyperslab to read instead of ftime/flevel: a dict of
+            per-dimension indices keyed by dimension name, e.g.
+            {'time': slice(None, None, 6), 'lat': slice(100, 200)},
+            or a tuple of them in dimension order; each is an int, a
+            slice, Ellipsis, or a list (or boolean mask) of indices. A
+            dict key that is not a dimension raises IndexError. Only the
+            selected values are read from the file.
+  squeeze - squeeze out dimensions of length 1 (default: True)
     '''
-    try:
-        nc = _Dataset(fname, 'r')
-    except IOError:
-        raise IOError('Unable to open %s' % fname)
 
-    if (not variable_exist(fname, vname)):
-        raise Execption('variable %s does not exist in %s') % (vname, fname)
+    return read_netCDF_vars(fname, [vname], oneD=oneD, ftime=ftime, flevel=flevel,
+                            index=index, squeeze=squeeze)[vname]
 
-    if (oneD):
-        var = nc.variables[vname][:]
-    else:
-        if ((ftime == -1) and (flevel == -1)):
-            var = nc.variables[vname][:, :]
-        elif ((ftime == -1) and (flevel != -1)):
-            var = nc.variables[vname][flevel, :, :]
-        elif ((ftime != -1) and (flevel == -1)):
-            var = nc.variables[vname][ftime, :, :]
-        elif ((ftime != -1) and (flevel != -1)):
-            var = nc.variables[vname][ftime, flevel, :, :]
-
-    try:
-        nc.close()
-    except IOError:
-        raise IOError('Unable to close %s' % fname)
-
-    return _np.squeeze(var)
+
+def read_netCDF_vars(fname, vnames, oneD=False, ftime=-1, flevel=-1, index=None, squeeze=True):
+    '''
+    Read several variables from a netCDF file in one open
+    Returns a dictionary of the variables by name; the arguments are those
+    of read_netCDF_var, and a dict index applies to the dimensions each
+    variable has, e.g. the same lat/lon box for all of them
+    '''
+
+    if (index is not None and (ftime != -1 or flevel != -1)):
+        raise ValueError('give either index or ftime/flevel, not both')
+
+    out = {}
+    with pooled_dataset(fname) as nc:
+
+        for vname in vnames:
+            if (vname not in nc.variables):
+                raise Exception('variable %s does not exist in %s' % (vname, fname))
+
+        if (isinstance(index, dict)):
+            dims = set()
+            for vname in vnames:
+                dims.update(nc.variables[vname].dimensions)
+            for dim in index:
+                if (dim not in dims):
+                    raise IndexError('index dimension %s is not a dimension of %s'
+                                     % (dim, ', '.join(vnames)))
+
+        for vname in vnames:
+            ncvar = nc.variables[vname]
+            if (index is not None):
+                var = ncvar[_hyperslab(ncvar, index)]
+            elif (oneD):
+                var = ncvar[:]
+            else:
+                if ((ftime == -1) and (flevel == -1)):
+                    var = ncvar[:, :]
+                elif ((ftime == -1) and (flevel != -1)):
+                    var = ncvar[flevel, :, :]
+                elif ((ftime != -1) and (flevel == -1)):
+                    var = ncvar[ftime, :, :]
+                elif ((ftime != -1) and (flevel != -1)):
+                    var = ncvar[ftime, flevel, :, :]
+            out[vname] = _np.squeeze(var) if (squeeze) else var
+
+    return out
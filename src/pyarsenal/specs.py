@@ -6,7 +6,7 @@ specs.py contains region and variable specifications
 
 import numpy as _np
 
-__all__ = ['region_specs', 'var_specs', 'field_specs']
+__all__ = ['region_specs', 'region_bounds', 'var_specs', 'field_specs']
 
 
 class _Container(object):
@@ -39,6 +39,23 @@ def region_specs(region='global'):
     return regionName
 
 
+def region_bounds(region='global'):
+    '''
+    region_bounds(region='global')
+    latitude bounds (south, north) in degrees of a region of region_specs
+    '''
+    regionName = region_specs(region)
+    if regionName in ['Northern Hemisphere']:
+        bounds = (20.0, 90.0)
+    elif regionName in ['Tropics']:
+        bounds = (-20.0, 20.0)
+    elif regionName in ['Southern Hemisphere']:
+        bounds = (-90.0, -20.0)
+    else:
+        bounds = (-90.0, 90.0)
+    return bounds
+
+
 def var_specs(var='temp'):
     '''
     var_specs(var='temp')
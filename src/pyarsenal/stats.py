@@ -4,45 +4,51 @@
 stats.py contains statistics utility functions
 '''
 
-__all__ = ['mstats', 'lregress', 'ttest', 'get_weights', 'get_weighted_mean']
+__all__ = ['mstats', 'mstats_accumulator', 'quantile_sketch', 'lregress', 'lregress_map', 'ttest', 'ttest_accumulator', 'bootstrap', 'get_weights', 'get_weighted_mean',
+           'region_weights', 'region_mean']
 
+import functools as _functools
+import os as _os
 import numpy as _np
+from concurrent.futures import ProcessPoolExecutor as _ProcessPoolExecutor
 from scipy.stats import t as _t
 
 
-def mstats(x):
+def mstats(x, k=None, blocksize=2**22, verbose=True):
     '''
     mstats : function that computes and displays
              various statistics of a variable
              A better alternative is scipy.stats.describe()
 
-    mstats(x)
+    OUT = mstats(x)
 
         x - variable whose statistics are to be computed and displayed
+        k - size of the quantile sketch for the median (default: exact median)
+blocksize - number of elements of x passed to the accumulator at a
+            time (default: 2**22)
+  verbose - print the statistics (default: True)
+      OUT - the statistics, see mstats_accumulator.result
+
+    The statistics are gathered in one pass with mstats_accumulator;
+    use it directly for data that does not fit in memory.
     '''
 
-    OUT = type('', (), {})
+    x = _np.asanyarray(x)
+    acc = mstats_accumulator(k=k)
+    xf = x.reshape(-1)
+    for i in range(0, max(xf.size, 1), blocksize):
+        acc.update(xf[i:i + blocksize])
+    acc.shape = _np.shape(x)
 
-    OUT.MatrixSize = _np.shape(x)
-    OUT.NElements = _np.prod(OUT.MatrixSize)
-    OUT.Nnans = _np.sum(_np.isnan(x))
-    OUT.NAnalyzedElements = OUT.NElements - OUT.Nnans
+    OUT = acc.result()
+    if verbose:
+        _print_mstats(OUT, x.dtype)
 
-    datatype = x.dtype
+    return OUT
 
-    xf = x.flatten()
-    xf = xf[~_np.isnan(xf)]
-    absxf = _np.abs(xf)
 
-    OUT.Mean = _np.mean(xf)
-    OUT.Max = _np.max(xf)
-    OUT.Min = _np.min(xf)
-    OUT.Median = _np.median(xf)
-    OUT.StDev = _np.std(xf, ddof=1)
-    OUT.MeanAbs = _np.mean(absxf)
-    OUT.MinAbs = _np.min(absxf[absxf > 0.0])
-    OUT.FracZero = len(xf[xf == 0.0]) / OUT.NAnalyzedElements
-    OUT.FracNan = OUT.Nnans / OUT.NElements
+def _print_mstats(OUT, datatype):
+    ''' display the statistics computed by mstats '''
 
     print('================= m s t a t s ==================')
     print('        MatrixSize: %s' % (str(OUT.MatrixSize)))
@@ -73,6 +79,243 @@ def mstats(x):
     return
 
 
+class quantile_sketch(object):
+    '''
+    quantile_sketch : bounded-memory estimate of the quantiles of a stream
+                      of values, after Karnin, Lang and Liberty (2016), KLL
+
+    A stack of compactors: level h holds values standing for 2**h input
+    values each. When a level outgrows its capacity it is sorted and every
+    other value (from a random start) is promoted to the next level. The
+    top level holds k values and lower levels geometrically fewer (2/3),
+    so fewer than 3k values are kept, and the rank error of a quantile is of
+    order 1/k of the count. Values are exact until more than k are seen.
+
+    sk = quantile_sketch(k=4096)
+    sk.update(block) ; sk.quantile(0.5)
+
+        k - capacity of the top compactor; None keeps every value (exact)
+     seed - seed of the random compaction offsets
+    '''
+
+    def __init__(self, k=4096, seed=None):
+        if (k is not None and k < 2):
+            raise ValueError('k must be at least 2, not %s' % k)
+        self.k = k
+        self.n = 0
+        self.levels = [[]]
+        self._rng = _np.random.default_rng(seed)
+
+    def _capacity(self, h):
+        depth = len(self.levels) - 1 - h
+        return max(2, int(_np.ceil(self.k * (2.0 / 3.0)**depth)))
+
+    def update(self, x):
+        ''' add the values in x (NaNs must be removed beforehand) '''
+
+        x = _np.ravel(x)
+        if (x.size == 0):
+            return
+        self.n += x.size
+        self.levels[0].append(_np.array(x))
+        if (self.k is not None):
+            self._compress()
+        return
+
+    def merge(self, other):
+        ''' add the values summarised by another sketch '''
+
+        while (len(self.levels) < len(other.levels)):
+            self.levels.append([])
+        for (h, level) in enumerate(other.levels):
+            self.levels[h].extend(level)
+        self.n += other.n
+        if (self.k is not None):
+            self._compress()
+        return
+
+    def _compress(self):
+        h = 0
+        while (h < len(self.levels)):
+            level = self.levels[h]
+            if (sum(v.size for v in level) > self._capacity(h)):
+                vals = _np.sort(_np.concatenate(level))
+                # an odd value out stays behind, the rest halves upwards
+                keep = vals[:vals.size % 2]
+                vals = vals[vals.size % 2:]
+                self.levels[h] = [keep] if (keep.size) else []
+                if (h + 1 == len(self.levels)):
+                    self.levels.append([])
+                self.levels[h + 1].append(vals[self._rng.integers(2)::2])
+            h += 1
+        return
+
+    def _values(self):
+        ''' values and weights held by the sketch '''
+
+        vals = []
+        weights = []
+        for (h, level) in enumerate(self.levels):
+            for v in level:
+                vals.append(v)
+                weights.append(_np.full(v.size, 2**h, dtype=_np.int64))
+        if (not vals):
+            return (_np.empty(0), _np.empty(0, dtype=_np.int64))
+        return (_np.concatenate(vals), _np.concatenate(weights))
+
+    def quantile(self, q):
+        '''
+        estimate of the q-th quantile (0 <= q <= 1), interpolated linearly
+        between ranks as numpy.quantile; equal to numpy.median for q=0.5
+        while the sketch is exact
+        '''
+
+        (vals, weights) = self._values()
+        if (vals.size == 0):
+            return _np.nan
+        if (len(self.levels) == 1):
+            return _np.median(vals) if (q == 0.5) else _np.quantile(vals, q)
+
+        order = _np.argsort(vals, kind='stable')
+        vals = vals[order]
+        # item i stands for the ranks cum[i] - weights[i] ... cum[i] - 1
+        cum = _np.cumsum(weights[order])
+        rank = q * (cum[-1] - 1)
+        lo = _np.searchsorted(cum, _np.floor(rank), side='right')
+        hi = _np.searchsorted(cum, _np.ceil(rank), side='right')
+        frac = rank - _np.floor(rank)
+        return vals[lo] + frac * (vals[hi] - vals[lo])
+
+
+class mstats_accumulator(object):
+    '''
+    mstats_accumulator : one-pass, bounded-memory version of mstats for
+                         data streamed in blocks, e.g. records of files
+
+    acc = mstats_accumulator()
+    for block in blocks:
+        acc.update(block)
+    OUT = acc.result()
+
+        k - size of the quantile sketch for the median (default: 4096,
+            see quantile_sketch; None for the exact median)
+     seed - seed of the quantile sketch
+
+    Mean and standard deviation are merged block by block with the
+    pairwise form of Welford's algorithm (Chan et al.) in double
+    precision. Accumulators of separate streams combine with merge.
+    '''
+
+    def __init__(self, k=4096, seed=None):
+        self.shape = None
+        self.nelements = 0
+        self.nnans = 0
+        self.nzeros = 0
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.sumabs = 0.0
+        self.min = None
+        self.max = None
+        self.minabs = _np.inf
+        self.sketch = quantile_sketch(k=k, seed=seed)
+
+    def update(self, x):
+        ''' add a block of data of any shape '''
+
+        x = _np.asanyarray(x)
+        if (self.shape is None):
+            self.shape = x.shape
+        elif (x.ndim > 0 and x.shape[1:] == self.shape[1:] and len(self.shape) == x.ndim):
+            self.shape = (self.shape[0] + x.shape[0],) + x.shape[1:]
+        else:
+            self.shape = (self.nelements + x.size,)
+        self.nelements += x.size
+
+        xf = x.reshape(-1)
+        if (xf.dtype.kind in 'fc'):
+            nans = _np.isnan(xf)
+            nnans = _np.count_nonzero(nans)
+            if (nnans > 0):
+                xf = xf[~nans]
+            self.nnans += nnans
+        if (xf.size == 0):
+            return
+
+        absxf = _np.abs(xf)
+        dtype = _np.complex128 if (xf.dtype.kind == 'c') else _np.float64
+        mean = xf.mean(dtype=dtype)
+        dev = xf - mean
+        m2 = _np.vdot(dev, dev).real
+        (n, nb) = (self.count, xf.size)
+        delta = mean - self.mean
+        self.count = n + nb
+        self.mean = self.mean + delta * nb / self.count
+        self.m2 = self.m2 + m2 + abs(delta)**2 * n * nb / self.count
+
+        self.sumabs += absxf.sum(dtype=_np.float64)
+        nonzero = _np.count_nonzero(xf)
+        self.nzeros += nb - nonzero
+        if (nonzero > 0):
+            top = _np.inf if (absxf.dtype.kind == 'f') else _np.iinfo(absxf.dtype).max
+            self.minabs = min(self.minabs, _np.min(absxf, where=absxf > 0, initial=top))
+        (xmin, xmax) = (_np.min(xf), _np.max(xf))
+        self.min = xmin if (self.min is None) else _np.minimum(self.min, xmin)
+        self.max = xmax if (self.max is None) else _np.maximum(self.max, xmax)
+        self.sketch.update(xf)
+        return
+
+    def merge(self, other):
+        ''' combine with the accumulator of another stream '''
+
+        if (other.count > 0):
+            (n, nb) = (self.count, other.count)
+            delta = other.mean - self.mean
+            self.count = n + nb
+            self.mean = self.mean + delta * nb / self.count
+            self.m2 = self.m2 + other.m2 + abs(delta)**2 * n * nb / self.count
+            self.sumabs += other.sumabs
+            self.minabs = min(self.minabs, other.minabs)
+            self.min = other.min if (self.min is None) else _np.minimum(self.min, other.min)
+            self.max = other.max if (self.max is None) else _np.maximum(self.max, other.max)
+            self.sketch.merge(other.sketch)
+        self.nelements += other.nelements
+        self.nnans += other.nnans
+        self.nzeros += other.nzeros
+        self.shape = (self.nelements,)
+        return
+
+    def result(self):
+        '''
+        the statistics of all data added so far, as attributes of OUT:
+        MatrixSize, NElements, Nnans, NAnalyzedElements, Mean, Max, Min,
+        Median, StDev, MeanAbs, MinAbs, FracZero, FracNan
+        MatrixSize is the shape of the blocks stacked along their first axis
+        (flattened if they do not stack). Median comes from the quantile
+        sketch, so it is approximate once more than k values were added.
+        '''
+
+        OUT = type('mstats', (), {})
+
+        OUT.MatrixSize = self.shape
+        OUT.NElements = self.nelements
+        OUT.Nnans = self.nnans
+        OUT.NAnalyzedElements = self.count
+
+        nan = _np.nan
+        OUT.Mean = self.mean if (self.count > 0) else nan
+        OUT.Max = self.max if (self.count > 0) else nan
+        OUT.Min = self.min if (self.count > 0) else nan
+        OUT.Median = self.sketch.quantile(0.5)
+        OUT.StDev = _np.sqrt(self.m2 / (self.count - 1)) if (self.count > 1) else nan
+        OUT.MeanAbs = self.sumabs / self.count if (self.count > 0) else nan
+        OUT.MinAbs = self.minabs if (_np.isfinite(self.minabs)) else nan
+        OUT.FracZero = self.nzeros / self.count if (self.count > 0) else nan
+        OUT.FracNan = self.nnans / self.nelements if (self.nelements > 0) else nan
+
+        return OUT
+
+
 def lregress(x, y, ci=95.0):
     '''
     lregress : function that computes the linear regression between
@@ -120,6 +363,93 @@ def lregress(x, y, ci=95.0):
     return [rc, sb, ssig]
 
 
+def lregress_map(x, y, ci=95.0, axis=0, chunksize=None):
+    '''
+    lregress_map : lregress at every point of a field at once, e.g. to
+                   regress a field onto an index; NaNs are skipped
+
+    [rc, sb, ssig] = lregress_map(x, y, ci=95.0, axis=0)
+
+        x - independent variable: a 1-D series of length nsamp, or an
+            array of the shape of y
+        y - dependent variable, with the nsamp samples along axis
+       ci - confidence interval (default: 95%)
+     axis - sample axis of y (and x) (default: 0)
+chunksize - number of grid points per chunk (default: 2**22 // nsamp,
+            so that a chunk holds about 2**22 samples)
+       rc - linear regression coefficient map
+       sb - standard error map on the linear regression coefficient
+     ssig - statistical significance map of the linear regression coefficient
+
+    At each point, the samples where x or y is NaN are left out, so the
+    sample size, and with it the critical t-value, may vary across points;
+    the t-values of all sample sizes are found in a single t.ppf call.
+    Points with fewer than 3 valid samples get NaN and are not significant.
+    y is converted to double precision a chunk at a time; with the samples
+    along the first axis of a contiguous y no copy of it is made.
+    '''
+
+    y = _np.moveaxis(_np.asanyarray(y), axis, 0)
+    x = _np.asanyarray(x, dtype=_np.float64)
+    nsamp = y.shape[0]
+    if (x.ndim == 1):
+        if (len(x) != nsamp):
+            raise ValueError('samples x and y are not of the same size')
+        x = x.reshape((nsamp, 1))
+    else:
+        x = _np.moveaxis(x, axis, 0)
+        if (x.shape != y.shape):
+            raise ValueError('x of shape %s does not match y of shape %s' % (x.shape, y.shape))
+        x = x.reshape((nsamp, -1))
+    shape = y.shape[1:]
+    y = y.reshape((nsamp, -1))
+    npts = y.shape[1]
+    if (chunksize is None):
+        chunksize = max(1, 2**22 // max(nsamp, 1))
+
+    n = _np.empty(npts, dtype=_np.int64)
+    rc = _np.empty(npts)
+    sb = _np.empty(npts)
+    for i0 in range(0, npts, chunksize):
+        i1 = min(i0 + chunksize, npts)
+        yc = _np.asarray(y[:, i0:i1], dtype=_np.float64)
+        xc = x if (x.shape[1] == 1) else x[:, i0:i1]
+        valid = ~(_np.isnan(xc) | _np.isnan(yc))
+        cnt = valid.sum(axis=0)
+        n[i0:i1] = cnt
+        # centered sums of squares over the valid samples, as numpy.cov
+        dx = _np.where(valid, xc, 0.0)
+        dx -= dx.sum(axis=0) / _np.maximum(cnt, 1)
+        dx *= valid
+        dy = _np.where(valid, yc, 0.0)
+        dy -= dy.sum(axis=0) / _np.maximum(cnt, 1)
+        dy *= valid
+        sxx = _np.einsum('ij,ij->j', dx, dx)
+        syy = _np.einsum('ij,ij->j', dy, dy)
+        sxy = _np.einsum('ij,ij->j', dx, dy)
+        with _np.errstate(divide='ignore', invalid='ignore'):
+            # regression coefficient (rc)
+            rc[i0:i1] = sxy / sxx
+            # total standard error squared (se)
+            se = (syy - (rc[i0:i1]**2) * sxx) / (cnt - 2)
+            # standard error on rc (sb)
+            sb[i0:i1] = _np.sqrt(se / sxx)
+
+    few = n < 3
+    rc[few] = _np.nan
+    sb[few] = _np.nan
+
+    pval = 1.0 - (1.0 - ci / 100.0) / 2.0
+    (nvals, inverse) = _np.unique(n, return_inverse=True)
+    tcrit = _t.ppf(pval, 2 * nvals - 2)[inverse]
+    # error bar on rc
+    eb = tcrit * sb
+    with _np.errstate(invalid='ignore'):
+        ssig = (_np.abs(rc) - _np.abs(eb)) > 0.0
+
+    return [rc.reshape(shape), sb.reshape(shape), ssig.reshape(shape)]
+
+
 def ttest(x, y=None, ci=95.0, paired=True, scale=False):
     '''
     Given two samples, perform the Student's t-test and return the errorbar
@@ -140,7 +470,7 @@ def ttest(x, y=None, ci=95.0, paired=True, scale=False):
 
     nsamp = x.shape[0]
 
-    if y == None:
+    if y is None:
         y = x.copy()
 
     pval = 1.0 - (1.0 - ci / 100.0) / 2.0
@@ -169,6 +499,346 @@ def ttest(x, y=None, ci=95.0, paired=True, scale=False):
     return diffmean, errorbar
 
 
+class _running_moments(object):
+    '''
+    NaN-aware running count, mean and sum of squared deviations at every
+    point of a field, updated one sample at a time (Welford)
+    '''
+
+    def __init__(self):
+        self.count = None
+
+    def update(self, x):
+        x = _np.asarray(x, dtype=_np.float64)
+        if (self.count is None):
+            self.count = _np.zeros(x.shape, dtype=_np.int64)
+            self.mean = _np.zeros(x.shape)
+            self.m2 = _np.zeros(x.shape)
+        valid = ~_np.isnan(x)
+        self.count += valid
+        delta = x - self.mean
+        _np.add(self.mean, delta / _np.maximum(self.count, 1), out=self.mean, where=valid)
+        _np.add(self.m2, delta * (x - self.mean), out=self.m2, where=valid)
+        return
+
+    def nanmean(self):
+        ''' as numpy.nanmean over the samples '''
+        return _np.where(self.count > 0, self.mean, _np.nan)
+
+    def nanvar(self, ddof=0):
+        ''' as numpy.nanvar over the samples '''
+        dof = self.count - ddof
+        return _np.divide(self.m2, dof, out=_np.full(self.m2.shape, _np.nan), where=dof > 0)
+
+
+class ttest_accumulator(object):
+    '''
+    ttest_accumulator : Student's t-test of ttest, accumulated one sample at
+                        a time, so that the memory needed is that of a few
+                        fields rather than of the full (nsamp, ...) stacks
+
+    acc = ttest_accumulator(ci=95.0, paired=True, scale=False)
+    for (x, y) in samples:
+        acc.update(x, y)
+    diffmean, errorbar = acc.result()
+
+    The arguments and results are those of ttest, which this reproduces
+    to rounding: means and variances skip NaNs at each point, while the
+    sample size nsamp counts every sample.
+    '''
+
+    def __init__(self, ci=95.0, paired=True, scale=False):
+        self.ci = ci
+        self.paired = paired
+        self.scale = scale
+        self.nsamp = 0
+        self._x = _running_moments()
+        self._y = _running_moments()
+        self._d = _running_moments()
+
+    def update(self, x, y=None):
+        '''
+        add one sample of the control x and experiment y (default: x)
+        '''
+
+        x = _np.asarray(x, dtype=_np.float64)
+        y = x if (y is None) else _np.asarray(y, dtype=_np.float64)
+        self._x.update(x)
+        self._y.update(y)
+        if self.paired:
+            self._d.update(y - x)
+        self.nsamp += 1
+        return
+
+    def result(self):
+        '''
+        diffmean - (normalized) difference in the sample means
+        errorbar - (normalized) errorbar with respect to control
+        '''
+
+        nsamp = self.nsamp
+        if (nsamp == 0):
+            raise ValueError('no samples have been added')
+
+        pval = 1.0 - (1.0 - self.ci / 100.0) / 2.0
+        tcrit = _t.ppf(pval, 2*(nsamp-1))
+
+        xmean = self._x.nanmean()
+        ymean = self._y.nanmean()
+
+        diffmean = ymean - xmean
+
+        if self.paired:
+            # paired t-test
+            std_err = _np.sqrt(self._d.nanvar(ddof=1) / nsamp)
+        else:
+            # unpaired t-test
+            std_err = _np.sqrt((self._x.nanvar(ddof=1) + self._y.nanvar(ddof=1)) / (nsamp-1.))
+
+        errorbar = tcrit * std_err
+
+        # normalize (rescale) the diffmean and errorbar
+        if self.scale:
+            scale_fac = 100.0 / xmean
+            diffmean = diffmean * scale_fac
+            errorbar = errorbar * scale_fac
+
+        return diffmean, errorbar
+
+
+# resamples drawn from one random stream; fixed, so that the resamples
+# depend on the seed only, not on the number of workers or chunks
+_BOOT_BATCH = 256
+
+# arrays shared with the bootstrap workers, by key: (SharedMemory, ndarray)
+_boot_shared = {}
+
+
+def _boot_prepare(statistic, x, y, paired):
+    '''
+    Reduce a bootstrap statistic to sums over the samples: returns the
+    group (resampling stream) sizes, a list of (group, array) whose
+    resampled sums make up the statistic, and how to combine the sums.
+    NaN samples are zeroed and left out of the counts.
+    '''
+
+    def valid(*arrs):
+        v = _np.ones(_np.broadcast(*arrs).shape)
+        for a in arrs:
+            v *= ~_np.isnan(a)
+        return v
+
+    def zeroed(a, v):
+        return _np.where(v > 0, a, 0.0)
+
+    if (statistic == 'mean' or (statistic == 'meandiff' and paired)):
+        d = x if (statistic == 'mean') else y - x
+        v = valid(d)
+        return ([d.shape[0]], [(0, zeroed(d, v)), (0, v)], 'ratio')
+    if (statistic == 'meandiff'):
+        (vx, vy) = (valid(x), valid(y))
+        return ([x.shape[0], y.shape[0]],
+                [(0, zeroed(x, vx)), (0, vx), (1, zeroed(y, vy)), (1, vy)], 'ratiodiff')
+    if (statistic == 'lregress'):
+        x = _np.broadcast_to(x, y.shape)
+        v = valid(x, y)
+        # center on the sample means, for accuracy of the sums of squares
+        xc = zeroed(x - _np.nanmean(_np.where(v > 0, x, _np.nan), axis=0), v)
+        yc = zeroed(y - _np.nanmean(_np.where(v > 0, y, _np.nan), axis=0), v)
+        return ([y.shape[0]], [(0, v), (0, xc), (0, yc), (0, xc * xc), (0, xc * yc)], 'regress')
+    raise ValueError("statistic must be 'mean', 'meandiff', 'lregress' or 'weighted_mean', not %s" % statistic)
+
+
+def _area_series(x, weights, naxes):
+    '''
+    weighted mean of every sample of x (samples along the first axis) over
+    its last naxes axes, which weights broadcast against; NaNs are skipped
+    '''
+
+    axes = tuple(range(x.ndim - naxes, x.ndim))
+    v = ~_np.isnan(x)
+    w = _np.where(v, weights, 0.0)
+    with _np.errstate(invalid='ignore', divide='ignore'):
+        return _np.sum(_np.where(v, x, 0.0) * w, axis=axes) / _np.sum(w, axis=axes)
+
+
+def _boot_finish(kind, sums):
+    ''' the statistic from the resampled sums of _boot_prepare '''
+
+    with _np.errstate(divide='ignore', invalid='ignore'):
+        if (kind == 'ratio'):
+            return sums[0] / sums[1]
+        if (kind == 'ratiodiff'):
+            return sums[2] / sums[3] - sums[0] / sums[1]
+        (n, sx, sy, sxx, sxy) = sums
+        return (sxy - sx * sy / n) / (sxx - sx * sx / n)
+
+
+def _boot_counts(size, nboot, seed):
+    '''
+    (nboot, size) matrix of how often each sample is drawn in each resample;
+    batches of _BOOT_BATCH resamples use streams spawned from the
+    SeedSequence seed
+    '''
+
+    streams = seed.spawn(-(-nboot // _BOOT_BATCH))
+    counts = _np.empty((nboot, size))
+    for (b, stream) in enumerate(streams):
+        k0 = b * _BOOT_BATCH
+        k1 = min(k0 + _BOOT_BATCH, nboot)
+        draws = _np.random.default_rng(stream).integers(0, size, (k1 - k0, size))
+        draws += _np.arange(k1 - k0)[:, None] * size
+        counts[k0:k1] = _np.bincount(draws.ravel(), minlength=(k1 - k0) * size).reshape((k1 - k0, size))
+    return counts
+
+
+def _boot_attach(specs):
+    ''' attach the shared arrays in a bootstrap worker '''
+
+    from multiprocessing import shared_memory as _shared_memory
+    for (key, name, shape) in specs:
+        shm = _shared_memory.SharedMemory(name=name)
+        _boot_shared[key] = (shm, _np.ndarray(shape, dtype=_np.float64, buffer=shm.buf))
+    return
+
+
+def _boot_chunk(kind, groups, keys, p0, p1, q):
+    ''' percentiles q of the bootstrap distribution at points p0:p1 '''
+
+    sums = []
+    for (g, key) in zip(groups, keys):
+        a = _boot_shared[key][1]
+        sums.append(_boot_shared['counts%d' % g][1] @ (a if (a.shape[1] == 1) else a[:, p0:p1]))
+    stat = _boot_finish(kind, sums)
+    if (_np.isnan(stat).any()):
+        return _np.nanpercentile(stat, q, axis=0)
+    return _np.percentile(stat, q, axis=0)
+
+
+def bootstrap(statistic, x, y=None, weights=None, nboot=10000, ci=95.0, axis=0,
+              paired=True, workers=None, seed=None, chunksize=None):
+    '''
+    bootstrap : percentile bootstrap confidence interval of a statistic at
+                every point of a field, free of the Gaussian assumption of
+                ttest and lregress
+
+    [estimate, lower, upper] = bootstrap(statistic, x, y=None, ...)
+
+ statistic - 'mean'          : mean of x
+             'meandiff'      : mean(y) - mean(x), as diffmean of ttest
+             'lregress'      : regression coefficient of y on x, as lregress_map
+             'weighted_mean' : mean over the samples of the area-weighted
+                               mean of each sample, as get_weighted_mean
+         x - samples along axis
+         y - samples along axis, for 'meandiff' and 'lregress'
+   weights - weights for 'weighted_mean', e.g. cos(lat)[:, None], that
+             broadcast against one sample of x; each sample is reduced to
+             its weighted mean over the trailing axes the weights span (all
+             axes but axis if weights has the shape of x), and that series
+             is bootstrapped, giving one interval per remaining point
+     nboot - number of resamples (default: 10000)
+        ci - confidence interval (default: 95%)
+      axis - sample axis (default: 0)
+    paired - resample x and y together for 'meandiff' (default: True)
+   workers - number of processes (default: all cores; 1 runs in process);
+             more than 1 needs Python 3.8
+      seed - seed of the resampling; the same seed gives the same
+             resamples, whatever the number of workers and chunksize
+ chunksize - number of points per task (default: about 2**25 bytes of
+             resampled statistics per task)
+  estimate - statistic of the samples
+     lower - lower bound of the confidence interval
+     upper - upper bound of the confidence interval
+
+    A resample is drawn as the count of each sample in it, so that the sums
+    the statistics are made of are a matrix product of the (nboot, nsamp)
+    counts with the (nsamp, points) data, for all resamples at once. The
+    same resamples are used at every point. NaN samples are skipped.
+    The inputs are placed in shared memory once and the points are spread
+    over a process pool.
+    '''
+
+    def samples(a):
+        if (a is None):
+            return None
+        a = _np.moveaxis(_np.asanyarray(a, dtype=_np.float64), axis, 0)
+        return a.reshape(a.shape[:1] + (-1,)) if (a.ndim > 1) else a.reshape((-1, 1))
+
+    x = _np.asanyarray(x)
+    shape = _np.moveaxis(x, axis, 0).shape[1:] if (x.ndim > 1) else ()
+    if (statistic in ['meandiff', 'lregress']):
+        if (y is None):
+            raise ValueError('%s needs both x and y' % statistic)
+        y = _np.asanyarray(y)
+        if (y.ndim > 1):
+            shape = _np.moveaxis(y, axis, 0).shape[1:]
+    if (statistic == 'weighted_mean'):
+        if (weights is None):
+            raise ValueError('weighted_mean needs weights')
+        x = _np.moveaxis(x, axis, 0)
+        weights = _np.asanyarray(weights)
+        if (weights.ndim == x.ndim):
+            weights = _np.moveaxis(weights, axis, 0)
+        naxes = min(weights.ndim, x.ndim - 1)
+        try:
+            _np.broadcast(weights, x)
+        except ValueError:
+            raise ValueError('data and weights mis-match array size')
+        x = _area_series(x, weights, naxes)
+        shape = x.shape[1:]
+        (statistic, axis) = ('mean', 0)
+    (sizes, arrays, kind) = _boot_prepare(statistic, samples(x), samples(y), paired)
+    groups = [g for (g, a) in arrays]
+    npts = max(a.shape[1] for (g, a) in arrays)
+
+    estimate = _boot_finish(kind, [a.sum(axis=0, keepdims=True) for (g, a) in arrays])[0]
+    q = [(100.0 - ci) / 2.0, 100.0 - (100.0 - ci) / 2.0]
+
+    if (workers is None):
+        workers = _os.cpu_count() or 1
+    if (chunksize is None):
+        chunksize = max(1, 2**22 // nboot)
+    chunks = [(p0, min(p0 + chunksize, npts)) for p0 in range(0, npts, chunksize)]
+    streams = _np.random.SeedSequence(seed).spawn(len(sizes))
+    counts = [_boot_counts(size, nboot, stream) for (size, stream) in zip(sizes, streams)]
+
+    named = [('counts%d' % g, c) for (g, c) in enumerate(counts)] + \
+        [('data%d' % i, a) for (i, (g, a)) in enumerate(arrays)]
+    keys = ['data%d' % i for i in range(len(arrays))]
+    bounds = _np.empty((2, npts))
+    if (workers == 1 or len(chunks) == 1):
+        _boot_shared.clear()
+        _boot_shared.update((key, (None, _np.ascontiguousarray(a))) for (key, a) in named)
+        try:
+            for (p0, p1) in chunks:
+                bounds[:, p0:p1] = _boot_chunk(kind, groups, keys, p0, p1, q)
+        finally:
+            _boot_shared.clear()
+    else:
+        # shared memory needs Python 3.8
+        from multiprocessing import shared_memory as _shared_memory
+        blocks = []
+        try:
+            specs = []
+            for (key, a) in named:
+                shm = _shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+                blocks.append(shm)
+                _np.ndarray(a.shape, dtype=_np.float64, buffer=shm.buf)[...] = a
+                specs.append((key, shm.name, a.shape))
+            with _ProcessPoolExecutor(min(workers, len(chunks)), initializer=_boot_attach,
+                                      initargs=(specs,)) as pool:
+                futures = [(p0, p1, pool.submit(_boot_chunk, kind, groups, keys, p0, p1, q))
+                           for (p0, p1) in chunks]
+                for (p0, p1, future) in futures:
+                    bounds[:, p0:p1] = future.result()
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+    return [estimate.reshape(shape)[()], bounds[0].reshape(shape)[()], bounds[1].reshape(shape)[()]]
+
+
 def get_weights(lats):
     '''
     Get weights for latitudes to do weighted mean
@@ -179,9 +849,89 @@ def get_weights(lats):
 def get_weighted_mean(data, weights, axis=None):
     '''
     Given the weights for latitudes, computed weighted mean of data in that direction
-    Note, data and wght must be same dimension
+    Note, weights must broadcast against data, e.g. cos(lat)[:, None] for (..., lat, lon)
+    data, or be 1-D along axis; a full-size copy of the weights is not needed
     Uses numpy.average
     '''
-    assert data.shape == weights.shape, ('data and weights mis-match array size')
+    data = _np.asanyarray(data)
+    weights = _np.asanyarray(weights)
+
+    if (weights.shape == data.shape or weights.ndim == 1 and isinstance(axis, int)):
+        return _np.average(data, weights=weights, axis=axis)
+
+    try:
+        wfull = _np.broadcast_to(weights, data.shape)
+    except ValueError:
+        raise ValueError('data and weights mis-match array size')
+    return _np.sum(data * weights, axis=axis) / _np.sum(wfull, axis=axis)
+
+
+@_functools.lru_cache(maxsize=64)
+def _region_weights(lats, dtype, region):
+    ''' cached region_weights, for latitudes as bytes '''
+    from pyarsenal.specs import region_bounds
+    lats = _np.frombuffer(lats, dtype=dtype)
+    (south, north) = region_bounds(region)
+    wght = get_weights(lats) * ((lats >= south) & (lats <= north))
+    wght.flags.writeable = False
+    return wght
+
+
+def region_weights(lats, region='global'):
+    '''
+    Area weights cos(lat) inside the latitude band of region ('nh', 'tr', 'sh'
+    or 'gl', see specs.region_bounds) and zero outside, for 1-D latitudes.
+    Computed once per grid and region and cached (read-only).
+    '''
+    lats = _np.ascontiguousarray(lats)
+    if (lats.ndim != 1):
+        raise ValueError('lats must be 1-D, not of shape %s' % (lats.shape,))
+    return _region_weights(lats.tobytes(), lats.dtype.str, region.lower())
+
 
-    return _np.average(data, weights=weights, axis=axis)
+def region_mean(data, lats, region='global', lat_axis=-2, lon_axis=-1, rms=False):
+    '''
+    Area-weighted mean (and root mean square) over regions of a regular
+    latitude-longitude grid, for any number of fields and times at once
+
+    data     - array with latitude and longitude axes, e.g. (time, lev, lat, lon)
+    lats     - 1-D latitudes (degrees)
+    region   - region name, or a list of them (see region_weights)
+    lat_axis - latitude axis of data (default: -2)
+    lon_axis - longitude axis of data (default: -1)
+    rms      - also return the area-weighted root mean square
+    returns the mean (and rms) with the latitude and longitude axes of data
+    removed, and a trailing region axis if region is a list
+
+    Data are first summed along longitude, then the zonal sums of all
+    regions are weighted in one matrix product, so no weight array of the
+    size of data is made. NaNs are left out of the means.
+    '''
+    regions = [region] if isinstance(region, str) else list(region)
+    data = _np.moveaxis(_np.asanyarray(data), (lat_axis, lon_axis), (-2, -1))
+    if (data.shape[-2] != len(lats)):
+        raise ValueError('data and weights mis-match array size')
+    wght = _np.stack([region_weights(lats, r) for r in regions], axis=-1)
+
+    zsum = data.sum(axis=-1, dtype=_np.float64)
+    if (rms):
+        zsqr = _np.einsum('...i,...i->...', data, data, dtype=_np.float64)
+    if (_np.isnan(zsum).any()):
+        valid = ~_np.isnan(data)
+        count = valid.sum(axis=-1) @ wght
+        zsum = _np.nansum(data, axis=-1, dtype=_np.float64)
+        if (rms):
+            zsqr = _np.einsum('...i,...i->...', _np.where(valid, data, 0.0), _np.where(valid, data, 0.0))
+    else:
+        count = data.shape[-1] * wght.sum(axis=0)
+
+    with _np.errstate(invalid='ignore', divide='ignore'):
+        mean = (zsum @ wght) / count
+        if (rms):
+            rmsv = _np.sqrt((zsqr @ wght) / count)
+    if isinstance(region, str):
+        mean = mean[..., 0]
+        if (rms):
+            rmsv = rmsv[..., 0]
+
+    return (mean, rmsv) if (rms) else mean
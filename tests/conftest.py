@@ -0,0 +1,20 @@
+# coding: utf-8 -*-
+
+'''
+Fixtures shared by the tests of pyarsenal
+'''
+
+import numpy as np
+import pytest
+
+
+@pytest.fixture(params=[np.float64, np.float32], ids=['float64', 'float32'])
+def dtype(request):
+    return request.param
+
+
+@pytest.fixture(params=['numpy', 'numba'])
+def backend(request):
+    if (request.param == 'numba'):
+        pytest.importorskip('numba')
+    return request.param
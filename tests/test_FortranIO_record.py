@@ -0,0 +1,87 @@
+# coding: utf-8 -*-
+
+'''
+Hyperslab reads of pyarsenal.FortranIO.FortranRecord against numpy
+'''
+
+import numpy as np
+import pytest
+
+import pyarsenal.FortranIO
+from pyarsenal.FortranIO import FortranIO, FortranRecord
+
+SHAPE = (5, 7, 301)
+
+KEYS = [
+    2,
+    -1,
+    (1, 3),
+    (4, -2, 100),
+    slice(1, 4),
+    (Ellipsis, slice(10, 200)),
+    (Ellipsis, slice(None, None, 3)),
+    (Ellipsis, slice(None, None, 150)),
+    (slice(None), slice(None, None, 2), slice(5, 290, 7)),
+    (slice(None, None, -1), slice(None), slice(None, None, -4)),
+    (slice(None, None, 2), Ellipsis),
+    (Ellipsis, 0),
+    (3, Ellipsis, slice(250, 3, -9)),
+    (slice(2, 2), Ellipsis),
+    Ellipsis,
+]
+
+
+@pytest.fixture(params=[False, True], ids=['record', 'subrecords'])
+def split(request, monkeypatch):
+    if (request.param):
+        # split the records into gfortran subrecords of a few kB
+        monkeypatch.setattr(pyarsenal.FortranIO, '_SUBRECORD', 1000)
+    return request.param
+
+
+@pytest.fixture
+def fname(split, tmp_path):
+    fname = str(tmp_path / 'record.bin')
+    with FortranIO(fname, 'wb', endian='>') as f:
+        f.writeArray(np.arange(10, dtype='>i4'))
+        f.writeArray(data())
+    return fname
+
+
+@pytest.fixture(params=[2**20, 64], ids=['window', 'small-window'])
+def scratchsize(request, monkeypatch):
+    monkeypatch.setattr(FortranRecord, '_scratchsize', request.param)
+
+
+def data():
+    return np.arange(np.prod(SHAPE), dtype='>f4').reshape(SHAPE)
+
+
+def test_segments(fname, split):
+    with FortranIO(fname, 'rb', endian='>') as f:
+        assert (len(f.record(1, np.float32).segments) > 1) == split
+
+
+@pytest.mark.parametrize('key', KEYS, ids=repr)
+def test_hyperslab(fname, scratchsize, key):
+    want = data()
+    with FortranIO(fname, 'rb', endian='>') as f:
+        pos = f.tell()
+        got = f.record(1, np.float32, SHAPE)[key]
+        assert f.tell() == pos
+    assert got.shape == want[key].shape
+    np.testing.assert_array_equal(got, want[key])
+
+
+@pytest.mark.parametrize('key', [slice(None, None, 1000), slice(None, None, -3),
+                                 slice(17, None, 2049), slice(5, 6)], ids=repr)
+def test_flat(fname, scratchsize, key):
+    want = data().ravel()
+    with FortranIO(fname, 'rb', endian='>') as f:
+        np.testing.assert_array_equal(f.record(1, np.float32)[key], want[key])
+
+
+def test_read_whole(fname):
+    with FortranIO(fname, 'rb', endian='>') as f:
+        np.testing.assert_array_equal(np.asarray(f.record(1, np.float32, SHAPE)), data())
+        np.testing.assert_array_equal(f.record(0, np.int32)[::-1], np.arange(10)[::-1])
@@ -0,0 +1,98 @@
+# coding: utf-8 -*-
+
+'''
+Equivalence of the numba and numpy backends of pyarsenal.meteor
+'''
+
+import numpy as np
+import pytest
+
+pytest.importorskip('numba')
+
+from pyarsenal.meteor import meteor
+
+SHAPE = (3, 5, 17, 23)
+RTOL = {np.float64: 1.0e-12, np.float32: 1.0e-5}
+
+
+@pytest.fixture
+def data(dtype):
+    rng = np.random.default_rng(0)
+    ny, nx = SHAPE[-2:]
+    x = np.cumsum(rng.uniform(0.5, 1.5, nx)).astype(dtype)
+    y = np.cumsum(rng.uniform(0.5, 1.5, ny)).astype(dtype)
+    mfac = rng.uniform(0.9, 1.1, (ny, nx)).astype(dtype)
+    return {
+        'fld': rng.standard_normal(SHAPE).astype(dtype),
+        'uwnd': rng.standard_normal(SHAPE).astype(dtype),
+        'vwnd': rng.standard_normal((ny, nx)).astype(dtype),
+        'x': x,
+        'y': y,
+        'x2': x * np.cos(np.linspace(-1.0, 1.0, ny))[:, None].astype(dtype),
+        'y2': y[:, None] * mfac,
+        'mfac': mfac,
+        'pres': np.linspace(1000.0, 100.0, SHAPE[-3]),
+        'rtol': RTOL[dtype],
+    }
+
+
+def check(name, rtol, *args, **kwargs):
+    want = getattr(meteor(backend='numpy'), name)(*args, **kwargs)
+    got = getattr(meteor(backend='numba'), name)(*args, **kwargs)
+    if (not isinstance(want, tuple)):
+        (want, got) = ((want,), (got,))
+    for (w, g) in zip(want, got):
+        assert g.dtype == w.dtype
+        # the kernels round once, numpy at every step: values that cancel
+        # to near zero are compared at the scale of the result
+        np.testing.assert_allclose(g, w, rtol=rtol, atol=rtol * np.abs(w).max())
+
+
+@pytest.mark.parametrize('axis', range(len(SHAPE)))
+@pytest.mark.parametrize('coord', ['scalar', '1d'])
+def test_deriv(data, axis, coord):
+    cin = 0.5 if (coord == 'scalar') else np.cumsum(np.linspace(0.5, 1.5, SHAPE[axis]))
+    check('deriv', data['rtol'], data['fld'], cin, axis=axis)
+
+
+def test_deriv_strided(data):
+    check('deriv', data['rtol'], data['fld'][..., ::2], data['x'][::2])
+
+
+@pytest.mark.parametrize('coord', ['1d', '2d'])
+def test_ddx(data, coord):
+    check('ddx', data['rtol'], data['fld'], data['x'] if (coord == '1d') else data['x2'])
+
+
+@pytest.mark.parametrize('coord', ['1d', '2d'])
+def test_ddy(data, coord):
+    check('ddy', data['rtol'], data['fld'], data['y'] if (coord == '1d') else data['y2'])
+
+
+def test_ddp(data):
+    check('ddp', data['rtol'], data['fld'], data['pres'])
+
+
+@pytest.mark.parametrize('coord', ['1d', 'mfac'])
+def test_gradient_2d(data, coord):
+    if (coord == '1d'):
+        check('gradient_2d', data['rtol'], data['fld'], data['x'], data['y'])
+    else:
+        check('gradient_2d', data['rtol'], data['fld'], data['x2'], 2.0, mfac=data['mfac'])
+
+
+@pytest.mark.parametrize('coord', ['1d', 'mfac', 'scalar'])
+def test_advection(data, coord):
+    if (coord == '1d'):
+        args, kwargs = (data['uwnd'], data['vwnd'], data['fld'], data['x'], data['y']), {}
+    elif (coord == 'mfac'):
+        args, kwargs = (data['uwnd'], data['vwnd'], data['fld'], data['x2'], 2.0), {'mfac': data['mfac']}
+    else:
+        args, kwargs = (1.0, data['vwnd'], data['fld'], 3.0, data['y']), {}
+    check('advection', data['rtol'], *args, **kwargs)
+
+
+def test_fallback_without_kernels(data):
+    # unsupported inputs (an integer field) take the numpy path
+    fld = np.arange(SHAPE[-1] * SHAPE[-2]).reshape(SHAPE[-2:])
+    check('ddx', 0.0, fld, data['x'])
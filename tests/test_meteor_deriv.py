@@ -0,0 +1,40 @@
+# coding: utf-8 -*-
+
+'''
+Finite differences of pyarsenal.meteor
+'''
+
+import numpy as np
+import pytest
+
+from pyarsenal.meteor import meteor
+
+
+def test_python_float_spacing_keeps_float32(backend):
+    met = meteor(backend=backend)
+    rng = np.random.default_rng(0)
+    fld = rng.standard_normal((3, 12, 17)).astype(np.float32)
+    wnd = rng.standard_normal((3, 12, 17)).astype(np.float32)
+    assert met.ddx(fld, 0.5).dtype == np.float32
+    assert met.ddy(fld, 0.5).dtype == np.float32
+    assert all(g.dtype == np.float32 for g in met.gradient_2d(fld, 0.5, 2.0))
+    assert met.advection(wnd, wnd, fld, 0.5, 2.0).dtype == np.float32
+    np.testing.assert_allclose(met.ddx(fld, 0.5), met.ddx(fld.astype(np.float64), 0.5), rtol=1.0e-5)
+
+
+@pytest.mark.parametrize('shape', [(30, 30), (30, 40), (4, 30, 40)], ids=['square', 'rect', '3d'])
+def test_1d_y_with_mfac(backend, shape):
+    met = meteor(backend=backend)
+    rng = np.random.default_rng(1)
+    fld = rng.standard_normal(shape)
+    wnd = rng.standard_normal(shape)
+    mfac = rng.uniform(0.9, 1.1, shape[-2:])
+    y = np.cumsum(rng.uniform(0.5, 1.5, shape[-2]))
+    want = met.gradient_2d(fld, 2.0, y[:, None], mfac=mfac)
+    for workers in [1, 4]:
+        got = met.gradient_2d(fld, 2.0, y, mfac=mfac, workers=workers)
+        for (g, w) in zip(got, want):
+            np.testing.assert_array_equal(g, w)
+    want = met.advection(wnd, wnd, fld, 2.0, y[:, None], mfac=mfac)
+    for workers in [1, 4]:
+        np.testing.assert_array_equal(met.advection(wnd, wnd, fld, 2.0, y, mfac=mfac, workers=workers), want)
@@ -0,0 +1,54 @@
+# coding: utf-8 -*-
+
+'''
+Tabulated saturation vapor pressure of pyarsenal.meteor
+'''
+
+import numpy as np
+import pytest
+
+from pyarsenal.meteor import meteor
+
+RTOL = 1.0e-6
+
+
+def test_within_bound(backend, dtype):
+    tin = np.linspace(150.0, 350.0, 100003).astype(dtype)
+    exact = meteor().sat_vapor_pressure(tin.astype(np.float64))
+    esat = meteor(backend=backend, esat='table', esat_rtol=RTOL).sat_vapor_pressure(tin)
+    assert esat.dtype == dtype
+    # the bound of the table, plus the rounding of the data type
+    np.testing.assert_allclose(esat, exact, rtol=RTOL + np.finfo(dtype).eps)
+
+
+def test_outside_range_is_exact(backend):
+    tin = np.array([100.0, 149.0, 351.0, 400.0, np.nan])
+    esat = meteor(backend=backend, esat='table').sat_vapor_pressure(tin)
+    np.testing.assert_allclose(esat, meteor().sat_vapor_pressure(tin), rtol=1.0e-14)
+    assert np.isnan(esat[-1])
+
+
+def test_out_and_broadcast(backend):
+    tin = np.linspace(200.0, 300.0, 7)
+    out = np.empty((3, 7))[:, ::-1]
+    met = meteor(backend=backend, esat='table')
+    esat = met.sat_vapor_pressure(tin, out=out)
+    assert esat is out
+    np.testing.assert_allclose(esat, np.broadcast_to(meteor().sat_vapor_pressure(tin), (3, 7)),
+                               rtol=RTOL)
+    assert np.ndim(met.sat_vapor_pressure(273.15)) == 0
+
+
+def test_diagnose(backend):
+    rng = np.random.default_rng(0)
+    tin = rng.uniform(200.0, 310.0, 50000)
+    pin = rng.uniform(300.0, 1000.0, 50000)
+    (esat, wsat) = meteor(backend=backend, esat='table').diagnose(['esat', 'wsat'], tin=tin, pin=pin)
+    met = meteor()
+    np.testing.assert_allclose(esat, met.sat_vapor_pressure(tin), rtol=RTOL)
+    np.testing.assert_allclose(wsat, met.sat_mixrat(met.sat_vapor_pressure(tin), pin), rtol=2 * RTOL)
+
+
+def test_bad_esat():
+    with pytest.raises(ValueError):
+        meteor(esat='spline')
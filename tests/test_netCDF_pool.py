@@ -0,0 +1,117 @@
+# coding: utf-8 -*-
+
+'''
+Handle pool of pyarsenal.netCDF
+'''
+
+import os
+
+import numpy as np
+import pytest
+
+netCDF4 = pytest.importorskip('netCDF4')
+
+import pyarsenal.netCDF
+from pyarsenal.netCDF import (close_datasets, pooled_dataset,
+                              read_netCDF_var, set_pool_size)
+
+
+def _write(fname, value):
+    with netCDF4.Dataset(fname, 'w') as nc:
+        nc.createDimension('x', 4)
+        var = nc.createVariable('t', 'f4', ('x',))
+        var[:] = np.full(4, value, np.float32)
+
+
+@pytest.fixture
+def fname(tmp_path):
+    fname = str(tmp_path / 'pool.nc')
+    _write(fname, 1.0)
+    yield fname
+    close_datasets()
+
+
+def test_reuses_handle(fname):
+    with pooled_dataset(fname) as nc1:
+        pass
+    with pooled_dataset(fname) as nc2:
+        assert nc2 is nc1
+        assert nc2.isopen()
+
+
+def test_nested_use(fname):
+    with pooled_dataset(fname) as nc1:
+        with pooled_dataset(fname) as nc2:
+            assert nc2 is nc1
+        assert nc1.isopen()
+
+
+def test_modified_file_closes_idle_handle(fname):
+    with pooled_dataset(fname) as nc1:
+        pass
+    st = os.stat(fname)
+    os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    with pooled_dataset(fname) as nc2:
+        assert nc2 is not nc1
+    assert not nc1.isopen()
+    close_datasets()
+    assert not nc2.isopen()
+
+
+def test_modified_file_keeps_handle_in_use(fname):
+    with pooled_dataset(fname) as nc1:
+        st = os.stat(fname)
+        os.utime(fname, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        with pooled_dataset(fname) as nc2:
+            assert nc2 is not nc1
+        assert nc1.isopen()
+    assert not nc1.isopen()
+
+
+def test_close_datasets_defers_to_user(fname):
+    with pooled_dataset(fname) as nc:
+        close_datasets(fname)
+        assert nc.isopen()
+    assert not nc.isopen()
+
+
+def test_rewrite_after_close(fname):
+    np.testing.assert_array_equal(read_netCDF_var(fname, 't', oneD=True), 1.0)
+    close_datasets(fname)
+    _write(fname, 2.0)
+    np.testing.assert_array_equal(read_netCDF_var(fname, 't', oneD=True), 2.0)
+
+
+def test_lru_eviction(tmp_path):
+    names = [str(tmp_path / ('f%d.nc' % i)) for i in range(3)]
+    for name in names:
+        _write(name, 0.0)
+    set_pool_size(2)
+    try:
+        handles = []
+        for name in names:
+            with pooled_dataset(name) as nc:
+                handles.append(nc)
+        assert [nc.isopen() for nc in handles] == [False, True, True]
+    finally:
+        set_pool_size(16)
+        close_datasets()
+
+
+def test_remote_dataset(fname, monkeypatch):
+    # an OPeNDAP URL is opened by the library, without a local file to stat
+    url = 'https://example.invalid/thredds/dodsC/pool.nc'
+    opened = []
+
+    def dataset(name, mode):
+        opened.append(name)
+        return netCDF4.Dataset(fname, mode)
+
+    monkeypatch.setattr(pyarsenal.netCDF, '_Dataset', dataset)
+    with pooled_dataset(url) as nc1:
+        pass
+    with pooled_dataset(url) as nc2:
+        assert nc2 is nc1
+    assert opened == [url]
+    close_datasets(url)
+    assert not nc1.isopen()
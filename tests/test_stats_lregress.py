@@ -0,0 +1,47 @@
+# coding: utf-8 -*-
+
+'''
+Gridpoint-vectorized linear regression of pyarsenal.stats
+'''
+
+import numpy as np
+import pytest
+
+from pyarsenal.stats import lregress, lregress_map
+
+
+@pytest.fixture
+def data():
+    rng = np.random.default_rng(0)
+    nsamp = 2000
+    x = rng.standard_normal(nsamp)
+    y = 1000.0 + 0.01 * x[:, None] + rng.standard_normal((nsamp, 6)) * 0.05
+    return x, y
+
+
+def _pointwise(x, y):
+    return np.array([lregress(x, y[:, j])[:2] for j in range(y.shape[1])]).T
+
+
+def test_matches_lregress(data):
+    (x, y) = data
+    (rc, sb, ssig) = lregress_map(x, y, chunksize=4)
+    np.testing.assert_allclose(np.array([rc, sb]), _pointwise(x, y), rtol=1.0e-8)
+    assert ssig.dtype == bool
+
+
+def test_float32_input(data):
+    (x, y) = data
+    y32 = y.astype(np.float32)
+    (rc, sb, ssig) = lregress_map(x, y32)
+    # the sums are in double precision, as lregress of the same values
+    np.testing.assert_allclose(np.array([rc, sb]), _pointwise(x, y32.astype(np.float64)), rtol=1.0e-6)
+
+
+def test_nans_skipped(data):
+    (x, y) = data
+    y = y.copy()
+    y[::3, 0] = np.nan
+    (rc, sb, ssig) = lregress_map(x, y)
+    keep = ~np.isnan(y[:, 0])
+    np.testing.assert_allclose([rc[0], sb[0]], lregress(x[keep], y[keep, 0])[:2], rtol=1.0e-8)